@@ -0,0 +1,315 @@
+import sys
+
+# Same sqlite3 remapping as main.py
+try:
+  __import__('pysqlite3')
+  sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+except ImportError:
+  pass
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+import numpy as np
+import pypdf
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+ROOT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_FOLDER = os.path.join(ROOT_FOLDER, "sample")
+BASELINE_PATH = os.path.join(ROOT_FOLDER, "benchmark_baseline.json")
+
+EMBEDDING_SIZE = 256
+WORDS_PER_PAGE = 350
+# A stage this much slower than the baseline is reported as a regression
+REGRESSION_THRESHOLD = 0.2
+SEED = 42
+
+QUERIES = [
+    "The Contractor shall complete the Works within 12 months from the date of award.",
+    "Payment shall be made within 30 days upon receipt of a valid invoice.",
+    "The defects liability period shall be 24 months after completion.",
+    "Liquidated damages shall be 0.1% of the Contract Sum per day of delay.",
+    "The performance bond shall be 10% of the Contract Sum.",
+    "The Contractor shall submit the insurance policies before commencement.",
+    "All submissions shall be in English.",
+    "The tender validity period shall be 90 days from the closing date.",
+    "Variations require the prior written approval of the Superintending Officer.",
+    "The warranty shall cover all parts and labour for 12 months.",
+]
+
+TOPICS = ["Contractor", "Employer", "Superintending Officer", "Tenderer", "Supplier", "Consultant"]
+OBLIGATIONS = ["shall submit", "shall complete", "shall provide", "shall maintain", "shall replace", "shall insure"]
+SUBJECTS = ["the Works", "the performance bond", "the warranty", "all drawings", "the programme", "the test reports"]
+PERIODS = ["within 7 days", "within 14 days", "within 30 days", "within 3 months", "within 12 months", "before handover"]
+CONDITIONS = ["at no additional cost", "unless otherwise approved", "to the satisfaction of the Employer",
+              "in accordance with the Specifications", "failing which damages shall apply", "as instructed"]
+
+
+class HashingEmbeddings(Embeddings):
+  """
+  Deterministic stand-in for OpenAIEmbeddings: hashed bag-of-words vectors,
+  so texts sharing words are still retrieved together. No network.
+  """
+
+  def embed_documents(self, texts):
+    return [self.embed_query(text) for text in texts]
+
+  def embed_query(self, text):
+    vector = np.zeros(EMBEDDING_SIZE, dtype=np.float32)
+    for word in re.findall(r"\w+", text.lower()):
+      code = zlib.crc32(word.encode("utf-8"))
+      vector[code % EMBEDDING_SIZE] += 1 if code & 1 else -1
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+def write_synthetic_text(path, pages, rng):
+  """Write a tender-like text file of numbered clauses, `pages` pages long."""
+
+  with open(path, "w", encoding="utf-8") as file:
+    clause = 1
+    for _ in range(pages):
+      words = 0
+      while words < WORDS_PER_PAGE:
+        sentence = (
+            f"{clause}. The {rng.choice(TOPICS)} {rng.choice(OBLIGATIONS)} {rng.choice(SUBJECTS)} "
+            f"{rng.choice(PERIODS)} {rng.choice(CONDITIONS)}."
+        )
+        file.write(sentence + "\n")
+        words += len(sentence.split())
+        clause += 1
+      file.write("\n")
+
+
+def write_synthetic_pdf(path, pages):
+  """Write a PDF of `pages` pages by repeating the pages of the samples."""
+
+  readers = [pypdf.PdfReader(os.path.join(SAMPLE_FOLDER, name)) for name in sorted(os.listdir(SAMPLE_FOLDER))]
+  sample_pages = [page for reader in readers for page in reader.pages]
+
+  writer = pypdf.PdfWriter()
+  for n in range(pages):
+    writer.add_page(sample_pages[n % len(sample_pages)])
+  with open(path, "wb") as file:
+    writer.write(file)
+
+
+def measure(stage, unit, fn, trace_memory):
+  """Run one stage and return its latency, peak memory and throughput."""
+
+  if trace_memory:
+    tracemalloc.start()
+  start = time.perf_counter()
+  count = fn()
+  seconds = time.perf_counter() - start
+  peak = 0
+  if trace_memory:
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+  return {
+      "stage": stage,
+      "seconds": round(seconds, 4),
+      "count": count,
+      "unit": unit,
+      "throughput": round(count / seconds, 2) if seconds else None,
+      "peak_mb": round(peak / 2**20, 2) if trace_memory else None,
+  }
+
+
+def run_benchmark(pages, trace_memory):
+  """
+  Run every stage of the pipeline once against a fresh database, blob store
+  and vector store in the current folder. Return the stage measurements.
+  """
+
+  # Imported here, after the working folder and settings are in place, as
+  # these modules create their folders and clients on import
+  import helper.llm
+  from helper.blob_store import open_blob
+  from helper.clause_check import check_clauses
+  from helper.conflicts import find_conflicts
+  from helper.context import retrieve_context
+  from helper.database import create_db, fetch_all
+  from helper.document import get_pages, split_docs
+  from helper.embedding_cache import CachedEmbeddings
+  from helper.index import build_file_index
+  from helper.pipeline import get_repository_files, import_directory
+
+  helper.llm.embeddings_model = CachedEmbeddings(HashingEmbeddings(), model_name="benchmark", max_entries=10**7)
+  helper.llm.llm = FakeListChatModel(responses=["No conflict"])
+
+  rng = random.Random(SEED)
+  documents_folder = os.path.join(os.getcwd(), "documents")
+  os.makedirs(documents_folder)
+  for name in sorted(os.listdir(SAMPLE_FOLDER)):
+    shutil.copy(os.path.join(SAMPLE_FOLDER, name), documents_folder)
+  write_synthetic_text(os.path.join(documents_folder, "Synthetic.txt"), pages, rng)
+  write_synthetic_pdf(os.path.join(documents_folder, "Synthetic.pdf"), pages)
+
+  create_db()
+  state = {}
+
+  def store():
+    state["files"] = get_repository_files(import_directory(documents_folder, "benchmark"))
+    return len(state["files"])
+
+  def fetch():
+    total = 0
+    for _, blob_hash in fetch_all("SELECT file_id, blob_hash FROM Files"):
+      with open_blob(blob_hash) as blob:
+        total += len(bytes(blob))
+    return round(total / 2**20, 2)
+
+  def load():
+    return sum(
+        len(get_pages(file_type, blob_hash))
+        for file_type, blob_hash in fetch_all("SELECT type, blob_hash FROM Files")
+    )
+
+  def split():
+    state["chunks"] = [
+        document
+        for file_name, file_type, blob_hash in fetch_all("SELECT file_name, type, blob_hash FROM Files")
+        for document in split_docs(file_name, file_type, blob_hash)
+    ]
+    return len(state["chunks"])
+
+  def embed():
+    helper.llm.embeddings_model.embed_documents([document.page_content for document in state["chunks"]])
+    return len(state["chunks"])
+
+  def index():
+    for file_id, file_name, file_type, blob_hash in fetch_all("SELECT file_id, file_name, type, blob_hash FROM Files"):
+      state.setdefault("indexes", {})[file_id] = build_file_index(file_id, file_name, file_type, blob_hash)
+    return len(state["chunks"])
+
+  def retrieve():
+    for vector_db in state["indexes"].values():
+      for query in QUERIES:
+        retrieve_context(vector_db, query)
+    return len(state["indexes"]) * len(QUERIES)
+
+  def check():
+    for file_id, file_name in state["files"].items():
+      check_clauses(file_id, file_name, QUERIES, helper.llm.embeddings_model.embed_documents(QUERIES))
+    return len(state["files"]) * len(QUERIES)
+
+  def analyse():
+    for file_id in state["files"]:
+      find_conflicts(file_id)
+    return len(state["files"])
+
+  return [
+      measure("store", "files", store, trace_memory),
+      measure("fetch", "MB", fetch, trace_memory),
+      measure("load", "pages", load, trace_memory),
+      measure("split", "chunks", split, trace_memory),
+      measure("embed", "chunks", embed, trace_memory),
+      # Includes re-splitting from the parsed text cache and cached embeddings
+      measure("index", "chunks", index, trace_memory),
+      measure("retrieve", "queries", retrieve, trace_memory),
+      measure("check", "clauses", check, trace_memory),
+      measure("analyse", "files", analyse, trace_memory),
+  ]
+
+  # End of run_benchmark()
+
+
+def compare_with_baseline(results, baseline):
+  """Print each stage against the baseline; return the regressed stages."""
+
+  previous = {stage["stage"]: stage for stage in baseline["stages"]}
+  regressions = []
+
+  print(f"{'stage':<10}{'seconds':>10}{'baseline':>10}{'change':>9}{'throughput':>16}{'peak MB':>10}")
+  for stage in results["stages"]:
+    before = previous.get(stage["stage"])
+    change = ""
+    if before and before["seconds"]:
+      ratio = stage["seconds"] / before["seconds"] - 1
+      change = f"{ratio:+.0%}"
+      if ratio > REGRESSION_THRESHOLD:
+        regressions.append(stage["stage"])
+        change += " !"
+    print(
+        f"{stage['stage']:<10}{stage['seconds']:>10.3f}"
+        f"{before['seconds'] if before else '-':>10}{change:>9}"
+        f"{stage['throughput'] or 0:>10.1f} {stage['unit']:<5}"
+        f"{stage['peak_mb'] if stage['peak_mb'] is not None else '-':>10}"
+    )
+
+  return regressions
+
+  # End of compare_with_baseline()
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+      description="Time every stage of the ingest-to-answer pipeline offline, with local stand-ins for the models.",
+  )
+  parser.add_argument("--pages", type=int, default=200, help="pages of each synthetic document")
+  parser.add_argument("--no-memory", action="store_true", help="skip peak memory tracing, which slows stages down")
+  parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file to compare with and save to")
+  parser.add_argument("--save", action="store_true", help="save this run as the new baseline")
+  args = parser.parse_args(argv)
+
+  # Every store the pipeline writes to lives in a throwaway folder
+  os.environ.update({
+      "DATABASE_NAME": "benchmark.db",
+      "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY") or "offline",
+      "OPENAI_MODEL_NAME": os.environ.get("OPENAI_MODEL_NAME") or "gpt-4o-mini",
+      "EMBEDDINGS_MODEL": "benchmark",
+  })
+  sys.path.insert(0, ROOT_FOLDER)
+  work_folder = tempfile.mkdtemp(prefix="benchmark_")
+  os.chdir(work_folder)
+
+  try:
+    stages = run_benchmark(args.pages, trace_memory=not args.no_memory)
+  finally:
+    os.chdir(ROOT_FOLDER)
+    shutil.rmtree(work_folder, ignore_errors=True)
+
+  results = {
+      "pages": args.pages,
+      "memory_traced": not args.no_memory,
+      "python": platform.python_version(),
+      "machine": platform.machine(),
+      "stages": stages,
+  }
+
+  baseline = {"stages": []}
+  if os.path.exists(args.baseline):
+    with open(args.baseline, encoding="utf-8") as file:
+      baseline = json.load(file)
+    if (baseline.get("pages"), baseline.get("memory_traced")) != (results["pages"], results["memory_traced"]):
+      print("Baseline was recorded with other settings; changes are not comparable.")
+  regressions = compare_with_baseline(results, baseline)
+
+  if args.save:
+    with open(args.baseline, "w", encoding="utf-8") as file:
+      json.dump(results, file, indent=2)
+      file.write("\n")
+    print(f"Saved baseline to {args.baseline}")
+
+  if regressions:
+    print(f"Slower than baseline by over {REGRESSION_THRESHOLD:.0%}: {', '.join(regressions)}")
+    return 1
+  return 0
+
+  # End of main()
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,87 @@
+import ast
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+# Seconds allowed to import everything main.py imports before first paint
+IMPORT_BUDGET_IN_SECONDS = float(os.environ.get("IMPORT_BUDGET_IN_SECONDS") or 1.5)
+RUNS = 3
+
+# Only the Analyse page and background workers may load these
+HEAVY_MODULES = [
+    "chromadb", "docx2txt", "langchain", "langchain_chroma", "langchain_core",
+    "langchain_openai", "openai", "pymupdf", "pypdf", "tiktoken",
+]
+
+MEASURE_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+for module in {modules!r}:
+  __import__(module)
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def get_startup_modules():
+  """Return the modules main.py imports at the top level, except sys."""
+
+  with open(os.path.join(ROOT_FOLDER, "main.py"), encoding="utf-8") as file:
+    tree = ast.parse(file.read())
+
+  modules = []
+  for node in tree.body:
+    if isinstance(node, ast.Import):
+      modules += [alias.name for alias in node.names]
+    elif isinstance(node, ast.ImportFrom) and node.level == 0:
+      modules.append(node.module)
+  return [module for module in dict.fromkeys(modules) if module != "sys"]
+
+
+def measure(modules):
+  """Import the modules in a fresh interpreter and an empty folder."""
+
+  with tempfile.TemporaryDirectory() as folder:
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE_SCRIPT.format(modules=modules, heavy=HEAVY_MODULES)],
+        cwd=folder,
+        env={**os.environ, "PYTHONPATH": ROOT_FOLDER, "DATABASE_NAME": "startup.db"},
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+  return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+  """
+  Fail if starting the app imports a heavy module or takes longer than
+  IMPORT_BUDGET_IN_SECONDS, taking the median of RUNS fresh interpreters.
+  """
+
+  modules = get_startup_modules()
+  results = [measure(modules) for _ in range(RUNS)]
+  seconds = statistics.median(result["seconds"] for result in results)
+  loaded = sorted({module for result in results for module in result["loaded"]})
+
+  print(f"Startup imports took {seconds:.2f}s (budget {IMPORT_BUDGET_IN_SECONDS:.2f}s)")
+  failed = False
+  if loaded:
+    print(f"Heavy modules loaded at startup: {', '.join(loaded)}")
+    failed = True
+  if seconds > IMPORT_BUDGET_IN_SECONDS:
+    print("Startup imports are over budget")
+    failed = True
+
+  return 1 if failed else 0
+
+  # End of main()
+
+
+if __name__ == "__main__":
+  sys.exit(main())
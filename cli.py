@@ -0,0 +1,124 @@
+import sys
+
+# Same sqlite3 remapping as main.py
+try:
+  __import__('pysqlite3')
+  sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+except ImportError:
+  pass
+
+import argparse
+import csv
+import json
+
+from helper.blob_store import migrate_inline_blobs
+from helper.clause_check import parse_clause_list
+from helper.database import compact_database, create_db, fetch_one
+from helper.pipeline import (MODE_ANALYSE, MODE_CHECK, MODE_COMPARE, RESULT_COLUMNS, get_repository_files,
+                             import_directory, run_analysis)
+from helper.tracing import start_run
+from helper.utility import get_secret_value
+
+EXIT_NO_CONFLICT = 0
+EXIT_CONFLICT = 1
+EXIT_ERROR = 2
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(
+      description="Analyse Tender documents for conflicting clauses without the web interface.",
+  )
+  source = parser.add_mutually_exclusive_group(required=True)
+  source.add_argument("--repository", help="id of an existing repository")
+  source.add_argument("--directory", help="folder of .docx, .pdf and .txt files, saved as a new repository")
+  source.add_argument("--compact-database", action="store_true",
+                      help="switch an older database to incremental vacuuming, then exit; run while the app is stopped")
+  parser.add_argument("--mode", choices=[MODE_ANALYSE, MODE_COMPARE, MODE_CHECK], default=MODE_ANALYSE,
+                      help="analyse each file, compare files against each other, or check clauses against each file")
+  parser.add_argument("--clause", action="append", default=[], help="clause to check; may be repeated")
+  parser.add_argument("--clauses-file", help="CSV or TXT file of clauses to check")
+  parser.add_argument("--format", choices=["json", "csv"], default="json")
+  parser.add_argument("--output", help="file to write results to; standard output by default")
+  parser.add_argument("--workers", type=int, default=int(get_secret_value("MAX_CONCURRENT_FILES") or 4),
+                      help="files processed in parallel")
+  parser.add_argument("--bypass-cache", action="store_true", help="ask the model again instead of reusing earlier answers")
+  return parser.parse_args(argv)
+
+
+def write_results(results, mode, output_format, output):
+  if output_format == "json":
+    json.dump({"mode": mode, "files": results}, output, ensure_ascii=False, indent=2)
+    output.write("\n")
+    return
+
+  writer = csv.writer(output)
+  writer.writerow(["file_name"] + RESULT_COLUMNS[mode])
+  for result in results:
+    for conflict in result["conflicts"]:
+      writer.writerow([result["file_name"]] + [conflict[column] for column in RESULT_COLUMNS[mode]])
+
+
+def main(argv=None):
+  """
+  Exit with 1 if any conflict is found, 2 if a file could not be analysed
+  or the input is invalid, and 0 otherwise.
+  """
+
+  args = parse_args(argv)
+
+  create_db()
+  if args.compact_database:
+    compact_database()
+    print("Database compacted", file=sys.stderr)
+    return EXIT_NO_CONFLICT
+
+  migrate_inline_blobs()
+
+  if args.directory:
+    try:
+      repository_id = import_directory(args.directory)
+    except (OSError, ValueError) as e:
+      print(e, file=sys.stderr)
+      return EXIT_ERROR
+    print(f"Saved {args.directory} as repository {repository_id}", file=sys.stderr)
+  else:
+    repository_id = args.repository
+    if not fetch_one("SELECT 1 FROM Repository WHERE repository_id = ?", [repository_id]):
+      print(f"Repository {repository_id} does not exist", file=sys.stderr)
+      return EXIT_ERROR
+
+  files_dict = get_repository_files(repository_id)
+  if args.mode == MODE_COMPARE and len(files_dict) < 2:
+    print("Comparing needs at least two files", file=sys.stderr)
+    return EXIT_ERROR
+
+  clauses = [clause.strip() for clause in args.clause if clause.strip()]
+  if args.clauses_file:
+    with open(args.clauses_file, encoding="utf-8-sig", errors="replace") as file:
+      clauses += parse_clause_list(file.read(), is_csv=args.clauses_file.lower().endswith(".csv"))
+  if args.mode == MODE_CHECK and not clauses:
+    print("Checking needs --clause or --clauses-file", file=sys.stderr)
+    return EXIT_ERROR
+
+  with start_run(args.mode, repository_id):
+    # The server that runs the index workers may be down, e.g. overnight
+    results = run_analysis(files_dict, mode=args.mode, clauses=clauses, use_cache=not args.bypass_cache,
+                           workers=args.workers, wait_for_jobs=False)
+
+  if args.output:
+    with open(args.output, "w", encoding="utf-8", newline="") as output:
+      write_results(results, args.mode, args.format, output)
+  else:
+    write_results(results, args.mode, args.format, sys.stdout)
+
+  if any(result["status"] == "failed" for result in results):
+    return EXIT_ERROR
+  if any(result["conflicts"] for result in results):
+    return EXIT_CONFLICT
+  return EXIT_NO_CONFLICT
+
+  # End of main()
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -1,23 +1,194 @@
+import hashlib
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, CancelledError, ThreadPoolExecutor, wait
+from functools import partial
+
 import pandas as pd
 import streamlit as st
 import streamlit_antd_components as sac
-from langchain.chains import RetrievalQA
-from langchain.document_loaders import PyPDFLoader, TextLoader, word_document
 from langchain.prompts import PromptTemplate
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_chroma import Chroma
 
-import helper
-from helper.database import fetch_all, fetch_one
-from helper.llm import count_tokens
-from helper.utility import save_blob_to_file
+from helper.clause_check import check_clauses, embed_clauses, parse_clause_list
+from helper.conflicts import find_conflicts, find_cross_file_conflicts
+from helper.context import retrieve_context
+from helper.database import fetch_all
+from helper.index import get_file_index
+from helper.jobs import get_indexing_files, show_files_status
+from helper.llm_cache import invoke_cached
+from helper.repository import fetch_repository_page
+from helper.tracing import in_current_run, start_run
+from helper.utility import get_secret_value
+
+MAX_CONCURRENT_FILES = int(get_secret_value("MAX_CONCURRENT_FILES") or 4)
+# How often streamed output is redrawn on the page
+STREAM_REFRESH_IN_SECONDS = 0.2
+STREAM_CURSOR = "▌"
+
+SEND_CLAUSE_TO_CHECK_TEMPLATE = """Use the following context to answer the question at the end. The provided context comes from a set of Tender documents. If you don't know the answer, simply state that you don't know — do not attempt to create an answer.
+
+      Clauses refer to the one or more sentences within one bullet point of the entire context you know.
+
+      **Role**: You are a Procurement Specialist.
+      **Goal**: Determine whether clause provided to you within <PromptXYZ> conflicts with the clauses you know.
+      **Backstory**: You are tasked to review if clause provided to you within <Prompt> conflicts with the clauses you know.
+
+      **Task**:
+      1. Carefully review the clauses in all the documents to build up your knowledge.
+      2. Read the <PromptXYZ> and check against what you know to determine if it conflicts with what you know.
+      3. If any conflicts are found, list the conflicting clauses in a table format. Include the following columns:
+      - S/N
+      - **Clause with conflicts**
+      - **Explanation**
+      Keep your Explanation short and concise.
+      
+      **Important**: Only include clauses that conflict with one another, otherwise, just answer "No conclict".
+
+      Finish your response with "Thank you!" on a new line at the end.
+      {context}
+
+      Remember that you are only going to take in question within below Prompt:
+      <Prompt>
+      {question}
+      </Prompt>
+      Analytical Answer:"""
+
+
+def ask_file(file_id, template, query, use_cache=True, on_token=None):
+  """
+  Answer a query against one file's index, streaming the answer to
+  `on_token`. Return (answer, True if served from the cache), or None if
+  the file cannot be indexed. Safe to run outside the script thread.
+  """
+
+  # Query the file's persistent index; embedding happens once at upload
+  vector_db = get_file_index(file_id)
+  if vector_db is None:
+    return None
+
+  # Fill the prompt with diverse relevant chunks, in document order
+  documents = retrieve_context(vector_db, query)
+  prompt = PromptTemplate.from_template(template).format(
+      context="\n\n".join(document.page_content for document in documents),
+      question=query,
+  )
+  # Chunk ids are reused when a file is replaced, so qualify them by content
+  chunk_ids = [
+      f"{document.metadata['chunk_id']}@{document.metadata.get('blob_hash', '')}"
+      if "chunk_id" in document.metadata
+      else hashlib.sha256(document.page_content.encode("utf-8")).hexdigest()
+      for document in documents
+  ]
+
+  return invoke_cached(prompt, key_parts=[template, chunk_ids, query], use_cache=use_cache, on_token=on_token)
+
+  # End of ask_file()
+
+
+def get_outcome(future):
+  """
+  Return the outcome of a finished file task, or None if it raised, e.g.
+  on a rate limit, so one file's failure does not lose the others'.
+  """
+
+  try:
+    return future.result()
+  except Exception:
+    return None
+
+
+def write_results(files_dict, task):
+  """
+  Run `task(file_id, on_token=...)` for every file concurrently. Output is
+  streamed into a placeholder per file as it is generated, and replaced by
+  the final result once the file finishes. A task returns (result, True if
+  served from the cache), or None if the file could not be processed.
+  Stopping the page cancels the files still running.
+  """
+
+  updates = queue.Queue()
+  cancelled = threading.Event()
+
+  def make_emitter(file_id):
+    def emit(text):
+      # Raised in the worker thread so that it stops asking the model
+      if cancelled.is_set():
+        raise CancelledError()
+      updates.put((file_id, text))
+
+    return emit
+
+  # Files are numbered in the order they first produce output
+  placeholders = {}
+  streamed = {}
+
+  def get_placeholder(file_id):
+    if file_id not in placeholders:
+      st.write(f"{len(placeholders) + 1}. Result for *{files_dict[file_id]}*")
+      placeholders[file_id] = st.empty()
+    return placeholders[file_id]
+
+  def render_updates():
+    changed = set()
+    while True:
+      try:
+        file_id, text = updates.get_nowait()
+      except queue.Empty:
+        break
+      streamed[file_id] = streamed.get(file_id, "") + text
+      changed.add(file_id)
+
+    for file_id in changed:
+      get_placeholder(file_id).markdown(streamed[file_id] + STREAM_CURSOR)
+
+  def render_result(file_id, outcome):
+    if outcome is None:
+      if file_id in placeholders:
+        placeholders[file_id].empty()
+      sac.alert(
+          label="Oops",
+          description=f"Something went wrong with {files_dict[file_id]}",
+          color="error",
+          banner=False,
+          icon=True,
+          closable=True,
+      )
+      return
+
+    result, cached = outcome
+    with get_placeholder(file_id).container():
+      if cached:
+        st.caption(":material/bolt: Served from cache")
+      st.write(result)
+
+  executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FILES)
+  try:
+    futures = {
+        executor.submit(in_current_run(task), file_id, on_token=make_emitter(file_id)): file_id
+        for file_id in files_dict
+    }
+
+    pending = set(futures)
+    while pending:
+      done, pending = wait(pending, timeout=STREAM_REFRESH_IN_SECONDS, return_when=FIRST_COMPLETED)
+      # Draw what was streamed before the final results replace it
+      render_updates()
+      for future in done:
+        render_result(futures[future], get_outcome(future))
+  finally:
+    # Also reached when the user stops or reruns the page
+    cancelled.set()
+    executor.shutdown(wait=False, cancel_futures=True)
 
-VECTOR_STORE_DIRECTORY = "./vector_store"
+  # End of write_results()
 
 
 def analyse_choose(title_repository_setup, disclaimer):
   st.subheader("Choose one repository from below to analyse.")
 
+  def use_cache():
+    return not st.session_state.get("key_analyse_step2_bypass_cache", False)
+
   def get_selected_row_index():
     row_index = -1
 
@@ -49,10 +220,7 @@ def analyse_choose(title_repository_setup, disclaimer):
 
       # End of handle_select_row()
 
-    data = fetch_all("""
-                      SELECT t1.name, t1.creation_date, t1.repository_id, (SELECT group_concat(t2.file_name, ', ') FROM Files t2 WHERE t2.repository_id = t1.repository_id)
-                      FROM Repository t1
-                      ORDER BY t1.creation_date DESC""")
+    data = fetch_repository_page("key_analyse_choose_page")
     if data:
       df = pd.DataFrame(data).set_axis(
           ["name", "creation_date", "repository_id", "file_name"], axis="columns"
@@ -115,6 +283,9 @@ def analyse_choose(title_repository_setup, disclaimer):
     if data:
       data_as_list = [f"{row[0]}: {row[1]}" for row in data]
 
+      with st.expander("Indexing status", icon=":material/hourglass_top:", expanded=False):
+        show_files_status(repository_id)
+
       selected_files = sac.transfer(
           items=data_as_list,
           label=None,
@@ -139,6 +310,21 @@ def analyse_choose(title_repository_setup, disclaimer):
       expander.write(disclaimer)
 
       if selected_files:
+        indexing = get_indexing_files([int(file.split(":")[0].strip()) for file in selected_files])
+        if indexing:
+          names = [file.split(":")[1].strip() for file in selected_files if int(file.split(":")[0].strip()) in indexing]
+          sac.alert(
+              label="Still indexing",
+              description=f"{', '.join(names)} will be analysed once indexing finishes.",
+              color="info",
+              banner=False,
+              icon=True,
+              closable=True,
+          )
+
+        st.toggle("Bypass cache", value=False, help="Ask the model again instead of reusing earlier answers",
+                  key="key_analyse_step2_bypass_cache")
+
         st.write("1. This will analyse the selected file(s) individually.")
         _, center1, _ = st.columns((3, 2, 3))
         if center1.button(
@@ -153,11 +339,33 @@ def analyse_choose(title_repository_setup, disclaimer):
                 int(file.split(":")[0].strip()): file.split(":")[1].strip()
                 for file in selected_files
             }
-            analyse_files(files_dict)
+            with start_run("analyse", repository_id):
+              analyse_files(files_dict)
+
+        sac.divider(label=None, variant="dotted", size="xs")
+
+        st.write("2. This will compare the clauses of the selected files against each other.")
+        _, center3, _ = st.columns((3, 2, 3))
+        if center3.button(
+            "Compare",
+            icon=":material/compare_arrows:",
+            type="primary",
+            use_container_width=True,
+            disabled=len(selected_files) < 2,
+            help="Select at least two files",
+            key="key_analyse_step2_btnCompare"
+        ):
+          with st.spinner("Analysis in progress ..."):
+            files_dict = {
+                int(file.split(":")[0].strip()): file.split(":")[1].strip()
+                for file in selected_files
+            }
+            with start_run("compare", repository_id):
+              compare_files(files_dict)
 
         sac.divider(label=None, variant="dotted", size="xs")
 
-        st.write("2. Input a Clause to check if it conflicts with any of the clauses within the selected file(s).")
+        st.write("3. Input a Clause to check if it conflicts with any of the clauses within the selected file(s).")
         st.text_area(label="Enter the Clause to check for conflict:", label_visibility="collapsed",
                      value="", placeholder="Enter the Clause to check for conflict", key="key_analyse_step2_clause")
         _, center2, _ = st.columns((3, 2, 3))
@@ -173,7 +381,31 @@ def analyse_choose(title_repository_setup, disclaimer):
                 int(file.split(":")[0].strip()): file.split(":")[1].strip()
                 for file in selected_files
             }
-            send_clause_to_check(files_dict)
+            with start_run("check_clause", repository_id):
+              send_clause_to_check(files_dict)
+
+        sac.divider(label=None, variant="dotted", size="xs")
+
+        st.write("4. Check a list of Clauses, one per line or from a CSV/TXT file, against the selected file(s).")
+        st.text_area(label="Enter the Clauses to check for conflict, one per line:", label_visibility="collapsed",
+                     value="", placeholder="Enter the Clauses to check for conflict, one per line",
+                     key="key_analyse_step2_clauses")
+        st.file_uploader("Or upload a list of Clauses", type=["csv", "txt"], key="key_analyse_step2_clauses_file")
+        _, center4, _ = st.columns((3, 2, 3))
+        if center4.button(
+            "Check all",
+            icon=":material/checklist:",
+            type="primary",
+            use_container_width=True,
+            key="key_analyse_step2_btnCheckAll"
+        ):
+          with st.spinner("Analysis in progress ..."):
+            files_dict = {
+                int(file.split(":")[0].strip()): file.split(":")[1].strip()
+                for file in selected_files
+            }
+            with start_run("check_clauses", repository_id):
+              check_clause_list(files_dict)
     else:
       sac.alert(
           label="Oops",
@@ -187,242 +419,129 @@ def analyse_choose(title_repository_setup, disclaimer):
     # End of step2()
 
   def analyse_files(files_dict):
-    collection_name = "honchun_abc_analyse_files"
-
-    def split_docs(file_name, file_type, file_data):
-      file_path = save_blob_to_file(file_data, file_name)
-
-      if (
-          file_type
-          == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-      ):
-        # docx
-        loader = word_document.Docx2txtLoader(file_path)
-      elif file_type == "application/pdf":
-        # pdf
-        loader = PyPDFLoader(file_path)
-      elif file_type == "text/plain":
-        # txt
-        loader = TextLoader(file_path)
-      else:
-        # Unrecognised type
-        sac.alert(
-            label="Oops",
-            description="Something went wrong",
-            color="error",
-            banner=False,
-            icon=True,
-            closable=True,
-        )
-        return
-
-      documents = loader.load()
-      text_splitter = RecursiveCharacterTextSplitter(
-          separators=["\n\n", "\n", " ", ""],
-          chunk_size=500,
-          chunk_overlap=50,
-          length_function=count_tokens,
-      )
-
-      splitted_documents = text_splitter.split_documents(documents)
-      return splitted_documents
+    if not files_dict:
+      return
 
-      # End of split_docs()
+    # Compare the most related clause pairs across each whole file
+    write_results(files_dict, partial(find_conflicts, use_cache=use_cache()))
+    # End of analyse_files()
 
-    if not files_dict:
+  def compare_files(files_dict):
+    if len(files_dict) < 2:
       return
 
-    i = 1
-    for file_id in files_dict:
-      data = fetch_one(
-          """
-                      SELECT file_id, repository_id, file_name, type, size, data
-                      FROM Files
-                      WHERE file_id = ?""",
-          [file_id],
-      )
-      file_name, file_type, file_data = data[2], data[3], data[5]
-      splitted_documents = split_docs(file_name, file_type, file_data)
+    st.write(f"Result across *{', '.join(files_dict.values())}*")
+    placeholder = st.empty()
+    streamed = []
 
-      # Delete vector store
-      vector_store = Chroma(
-          persist_directory=VECTOR_STORE_DIRECTORY, collection_name=collection_name
-      )
-      client = vector_store._client
-      for collection in client.list_collections():
-        client.delete_collection(collection.name)
-
-      # Create the vector db
-      vector_db = Chroma.from_documents(
-          documents=splitted_documents,
-          embedding=helper.llm.embeddings_model,
-          collection_name=collection_name,  # one database can have multiple collections
-          persist_directory=VECTOR_STORE_DIRECTORY,
-      )
+    def on_token(text):
+      streamed.append(text)
+      placeholder.markdown("".join(streamed) + STREAM_CURSOR)
 
-      query = """Tell me the conflicting clauses you know of."""
+    outcome = find_cross_file_conflicts(files_dict, use_cache=use_cache(), on_token=on_token)
+    placeholder.empty()
+    if outcome is None:
+      sac.alert(
+          label="Oops",
+          description="Something went wrong",
+          color="error",
+          banner=False,
+          icon=True,
+          closable=True,
+      )
+      return
 
-      # Build prompt
-      template = """Use the following context to answer the question at the end. The provided context comes from a set of Tender documents. If you don't know the answer, simply state that you don't know — do not attempt to create an answer.
+    result, cached = outcome
+    if cached:
+      st.caption(":material/bolt: Served from cache")
+    st.write(result)
+    # End of compare_files()
 
-      Clauses refer to the one or more sentences within one bullet point of the entire context you know. You are to process everything before responding.
+  def send_clause_to_check(files_dict):
+    if not files_dict:
+      return
 
-      **Role**: You are a Procurement Specialist.
-      **Goal**: Determine whether any clauses within the provided Tender documents conflict with each other.
-      **Backstory**: You are tasked with reviewing one or more Tender documents to identify any conflicting clauses.
+    query = st.session_state["key_analyse_step2_clause"]
+    write_results(
+        files_dict,
+        partial(ask_file, template=SEND_CLAUSE_TO_CHECK_TEMPLATE, query=query, use_cache=use_cache()),
+    )
+    # End of send_clause_to_check()
 
-      **Task**:
-      1. Carefully review the clauses in all the documents.
-      2. Identify conflicts by analyzing each clause as a whole and comparing against all clauses across the entire context before you conclude.
-      3. If any conflicts are found, list the conflicting clauses in a table format. Include the following columns:
-      - S/N
-      - **Source 1**
-      - **Source 2**
-      - ...
-      - **Explanation**
-      Keep your Explanation short and concise.
-      
-      **Important**: Only include clauses that conflict with one another, otherwise, just answer "No conclict".
+  def check_clause_list(files_dict):
+    if not files_dict:
+      return
 
-      Finish your response with "Thank you!" on a new line at the end.
-      {context}
-      Question: {question}
-      Analytical Answer:"""
-      QA_CHAIN_PROMPT = PromptTemplate.from_template(template)
-      qa_chain = RetrievalQA.from_chain_type(
-          helper.llm.llm,
-          retriever=vector_db.as_retriever(),
-          return_source_documents=True,  # Make inspection of document possible
-          chain_type_kwargs={"prompt": QA_CHAIN_PROMPT},
+    clauses = parse_clause_list(st.session_state["key_analyse_step2_clauses"])
+    uploaded_file = st.session_state["key_analyse_step2_clauses_file"]
+    if uploaded_file is not None:
+      clauses += parse_clause_list(
+          uploaded_file.getvalue().decode("utf-8-sig", errors="replace"),
+          is_csv=uploaded_file.name.lower().endswith(".csv"),
+      )
+    if not clauses:
+      sac.alert(
+          label="No Clauses to check",
+          description="Enter the Clauses one per line or upload a CSV/TXT file.",
+          color="warning",
+          banner=False,
+          icon=True,
+          closable=True,
       )
-      llm_response = qa_chain.invoke(query)
+      return
 
-      result = llm_response["result"]
+    # Embedded once and reused for the retrieval of every file
+    embeddings = embed_clauses(clauses)
 
-      st.write(f"{i}. Result for *{file_name}*")
-      i = i + 1
-      st.write(result)
-    # End of analyse_files()
+    task = partial(check_clauses, clauses=clauses, embeddings=embeddings, use_cache=use_cache())
+    executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FILES)
+    try:
+      futures = [executor.submit(in_current_run(task), file_id, file_name) for file_id, file_name in files_dict.items()]
+      outcomes = [get_outcome(future) for future in futures]
+    finally:
+      executor.shutdown(wait=False, cancel_futures=True)
 
-  def send_clause_to_check(files_dict):
-    collection_name = "honchun_abc_send_clause_to_check"
-
-    def split_docs(file_name, file_type, file_data):
-      file_path = save_blob_to_file(file_data, file_name)
-
-      if (
-          file_type
-          == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-      ):
-        # docx
-        loader = word_document.Docx2txtLoader(file_path)
-      elif file_type == "application/pdf":
-        # pdf
-        loader = PyPDFLoader(file_path)
-      elif file_type == "text/plain":
-        # txt
-        loader = TextLoader(file_path)
-      else:
-        # Unrecognised type
+    rows = []
+    for file_id, outcome in zip(files_dict, outcomes):
+      if outcome is None:
         sac.alert(
             label="Oops",
-            description="Something went wrong",
+            description=f"Something went wrong with {files_dict[file_id]}",
             color="error",
             banner=False,
             icon=True,
             closable=True,
         )
-        return
-
-      documents = loader.load()
-      text_splitter = RecursiveCharacterTextSplitter(
-          separators=["\n\n", "\n", " ", ""],
-          chunk_size=500,
-          chunk_overlap=50,
-          length_function=count_tokens,
-      )
-
-      splitted_documents = text_splitter.split_documents(documents)
-      return splitted_documents
-
-      # End of split_docs()
-
-    if not files_dict:
+        continue
+      rows += [[files_dict[file_id]] + row for row in outcome[0]]
+
+    st.write(f"Result for {len(clauses)} Clauses across *{', '.join(files_dict.values())}*")
+    succeeded = [outcome for outcome in outcomes if outcome is not None]
+    if succeeded and all(outcome[1] for outcome in succeeded):
+      st.caption(":material/bolt: Served from cache")
+    if not rows:
+      st.write("No conflict")
       return
 
-    i = 1
-    for file_id in files_dict:
-      data = fetch_one(
-          """
-                      SELECT file_id, repository_id, file_name, type, size, data
-                      FROM Files
-                      WHERE file_id = ?""",
-          [file_id],
-      )
-      file_name, file_type, file_data = data[2], data[3], data[5]
-      splitted_documents = split_docs(file_name, file_type, file_data)
-
-      # Delete vector store
-      vector_store = Chroma(
-          persist_directory=VECTOR_STORE_DIRECTORY, collection_name=collection_name
-      )
-      client = vector_store._client
-      for collection in client.list_collections():
-        client.delete_collection(collection.name)
-
-      # Create the vector db
-      vector_db = Chroma.from_documents(
-          documents=splitted_documents,
-          embedding=helper.llm.embeddings_model,
-          collection_name=collection_name,  # one database can have multiple collections
-          persist_directory=VECTOR_STORE_DIRECTORY,
-      )
-
-      query = st.session_state["key_analyse_step2_clause"]
-
-      # Build prompt
-      template = """Use the following context to answer the question at the end. The provided context comes from a set of Tender documents. If you don't know the answer, simply state that you don't know — do not attempt to create an answer.
-
-      Clauses refer to the one or more sentences within one bullet point of the entire context you know.
-
-      **Role**: You are a Procurement Specialist.
-      **Goal**: Determine whether clause provided to you within <PromptXYZ> conflicts with the clauses you know.
-      **Backstory**: You are tasked to review if clause provided to you within <Prompt> conflicts with the clauses you know.
-
-      **Task**:
-      1. Carefully review the clauses in all the documents to build up your knowledge.
-      2. Read the <PromptXYZ> and check against what you know to determine if it conflicts with what you know.
-      3. If any conflicts are found, list the conflicting clauses in a table format. Include the following columns:
-      - S/N
-      - **Clause with conflicts**
-      - **Explanation**
-      Keep your Explanation short and concise.
-      
-      **Important**: Only include clauses that conflict with one another, otherwise, just answer "No conclict".
-
-      Finish your response with "Thank you!" on a new line at the end.
-      {context}
-
-      Remember that you are only going to take in question within below Prompt:
-      <Prompt>
-      {question}
-      </Prompt>
-      Analytical Answer:"""
-      QA_CHAIN_PROMPT = PromptTemplate.from_template(template)
-      qa_chain = RetrievalQA.from_chain_type(
-          helper.llm.llm,
-          retriever=vector_db.as_retriever(),
-          return_source_documents=True,  # Make inspection of document possible
-          chain_type_kwargs={"prompt": QA_CHAIN_PROMPT},
-      )
-      llm_response = qa_chain.invoke(query)
-
-      result = llm_response["result"]
-
-      st.write(f"{i}. Result for *{file_name}*")
-      i = i + 1
-      st.write(result)
-    # End of send_clause_to_check()
+    df = pd.DataFrame(rows, columns=["file_name", "clause", "conflict", "explanation"])
+    st.dataframe(
+        df,
+        column_config={
+            "file_name": st.column_config.Column("File", width="small"),
+            "clause": st.column_config.Column("Clause", width="medium"),
+            "conflict": st.column_config.Column("Clause with conflicts", width="medium"),
+            "explanation": st.column_config.Column("Explanation", width="medium"),
+        },
+        hide_index=True,
+    )
+    st.download_button(
+        "Download CSV",
+        data=df.to_csv(index=False).encode("utf-8"),
+        file_name="clause_check.csv",
+        mime="text/csv",
+        icon=":material/download:",
+    )
+    # End of check_clause_list()
 
   steps_options = sac.steps(
       items=[
@@ -0,0 +1,183 @@
+import hashlib
+import io
+import mmap
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import partial
+
+from helper.database import execute_non_query, fetch_all, fetch_one, transaction
+
+BLOB_STORE_FOLDER = os.path.join(os.getcwd(), "blob_store")
+BLOB_CHUNK_SIZE = 2**20
+# Files of the blob store without a Blobs row are deleted once this old
+ORPHANED_BLOB_AGE_IN_SECONDS = 3600
+
+if not os.path.exists(BLOB_STORE_FOLDER):
+  os.makedirs(BLOB_STORE_FOLDER)
+
+
+def get_blob_path(blob_hash):
+  return os.path.join(BLOB_STORE_FOLDER, blob_hash[:2], blob_hash)
+
+
+def stage_blob(file):
+  """
+  Copy a readable binary file into a temporary file of the blob store
+  BLOB_CHUNK_SIZE bytes at a time, hashing it on the way, and return
+  (hash, size, temporary path). Copying a large file takes a while, so do
+  it outside any transaction and `commit_blob` the result inside the one
+  that inserts the referencing row.
+  """
+
+  digest = hashlib.sha256()
+  size = 0
+  # Written next to its final place so that moving it there is a rename
+  fd, temp_path = tempfile.mkstemp(dir=BLOB_STORE_FOLDER)
+  try:
+    with os.fdopen(fd, "wb") as temp_file:
+      for chunk in iter(partial(file.read, BLOB_CHUNK_SIZE), b""):
+        digest.update(chunk)
+        temp_file.write(chunk)
+        size += len(chunk)
+  except BaseException:
+    os.remove(temp_path)
+    raise
+
+  return digest.hexdigest(), size, temp_path
+
+  # End of stage_blob()
+
+
+@contextmanager
+def staged_blobs(files):
+  """
+  Stage every file with `stage_blob` and yield the results in order.
+  Temporary files not committed by the end are removed.
+  """
+
+  staged = []
+  try:
+    for file in files:
+      staged.append(stage_blob(file))
+    yield staged
+  finally:
+    for _, _, temp_path in staged:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+  # End of staged_blobs()
+
+
+def commit_blob(blob_hash, size, temp_path):
+  """
+  Move a staged blob into place and record it, returning (hash, size).
+  Identical content is kept once; Files rows referencing the hash keep it
+  alive, so call this inside the transaction that inserts the referencing
+  row. Readers never see a partial blob, as it only arrives by a rename.
+  """
+
+  execute_non_query(
+      "INSERT OR IGNORE INTO Blobs (blob_hash, size, ref_count) VALUES (?, ?, 0)",
+      [blob_hash, size],
+  )
+
+  blob_path = get_blob_path(blob_hash)
+  if os.path.exists(blob_path):
+    os.remove(temp_path)
+  else:
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    os.replace(temp_path, blob_path)
+
+  return blob_hash, size
+
+  # End of commit_blob()
+
+
+def put_blob_stream(file):
+  """Stage and commit a readable binary file in one go; see `stage_blob`."""
+
+  return commit_blob(*stage_blob(file))
+
+
+def put_blob(data):
+  """Store in-memory bytes like `put_blob_stream` and return their hash."""
+
+  return put_blob_stream(io.BytesIO(data))[0]
+
+
+@contextmanager
+def open_blob(blob_hash):
+  """Yield a read-only memory map of a stored blob."""
+
+  with open(get_blob_path(blob_hash), "rb") as file:
+    if os.fstat(file.fileno()).st_size == 0:
+      yield b""
+      return
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      yield data
+
+
+def purge_unreferenced_blobs():
+  """Delete blobs that no Files row refers to any more."""
+
+  data = fetch_all("SELECT blob_hash FROM Blobs WHERE ref_count <= 0")
+  for row in data:
+    blob_hash = row[0]
+    with transaction():
+      # Re-check, as the same content may have been uploaded meanwhile
+      if not fetch_one("SELECT 1 FROM Blobs WHERE blob_hash = ? AND ref_count <= 0", [blob_hash]):
+        continue
+      execute_non_query("DELETE FROM Blobs WHERE blob_hash = ?", [blob_hash])
+      execute_non_query("DELETE FROM ParsedText WHERE blob_hash = ?", [blob_hash])
+      if os.path.exists(get_blob_path(blob_hash)):
+        os.remove(get_blob_path(blob_hash))
+
+  # End of purge_unreferenced_blobs()
+
+
+def sweep_orphaned_blob_files():
+  """
+  Delete files of the blob store that no Blobs row records: blobs moved
+  into place by a transaction that was then rolled back, and temporary
+  files of interrupted uploads. Files newer than ORPHANED_BLOB_AGE_IN_SECONDS
+  may belong to an upload in progress and are kept.
+  """
+
+  cutoff = time.time() - ORPHANED_BLOB_AGE_IN_SECONDS
+  for folder, _, names in os.walk(BLOB_STORE_FOLDER):
+    for name in names:
+      path = os.path.join(folder, name)
+      # Temporary files sit at the top; blobs are filed under their hash
+      is_blob = folder != BLOB_STORE_FOLDER
+      try:
+        if os.path.getmtime(path) > cutoff:
+          continue
+      except FileNotFoundError:
+        continue
+      if is_blob and fetch_one("SELECT 1 FROM Blobs WHERE blob_hash = ?", [name]):
+        continue
+
+      with transaction():
+        # Re-check, as the same content may be committed meanwhile
+        if is_blob and fetch_one("SELECT 1 FROM Blobs WHERE blob_hash = ?", [name]):
+          continue
+        if os.path.exists(path):
+          os.remove(path)
+
+  # End of sweep_orphaned_blob_files()
+
+
+def migrate_inline_blobs():
+  """Move file content still stored inline in Files into the blob store."""
+
+  data = fetch_all("SELECT file_id FROM Files WHERE blob_hash IS NULL")
+  for row in data:
+    file_id = row[0]
+    file_data = fetch_one("SELECT data FROM Files WHERE file_id = ?", [file_id])[0]
+    with transaction():
+      blob_hash = put_blob(file_data)
+      execute_non_query("UPDATE Files SET blob_hash = ?, data = x'' WHERE file_id = ?", [blob_hash, file_id])
+
+  # End of migrate_inline_blobs()
@@ -0,0 +1,162 @@
+import csv
+import io
+import re
+
+import helper
+from helper.conflicts import get_table_rows
+from helper.context import CONTEXT_TOKEN_BUDGET, retrieve_context_by_vector
+from helper.index import get_file_index
+from helper.llm import count_tokens_batch
+from helper.llm_cache import batch_cached
+
+# Tokens of context retrieved for each clause
+CLAUSE_CONTEXT_TOKEN_BUDGET = CONTEXT_TOKEN_BUDGET // 4
+# Most clauses checked in one prompt
+CLAUSES_PER_PROMPT = 10
+
+CHECK_CLAUSES_TEMPLATE = """Use the following context to check the numbered clauses at the end. The provided context comes from the Tender document {file_name}. If you don't know the answer, simply state that you don't know — do not attempt to create an answer.
+
+Clauses refer to the one or more sentences within one bullet point of the context you are given.
+
+**Role**: You are a Procurement Specialist.
+**Goal**: Determine whether each numbered clause within <Clauses> conflicts with the clauses in the context.
+
+**Task**:
+1. Compare every numbered clause within <Clauses> against the clauses in the context.
+2. If any conflicts are found, list them in a table format. Include the following columns:
+- S/N
+- **Clause No.** (the number of the clause within <Clauses>)
+- **Clause with conflicts** (the conflicting clause from the context)
+- **Explanation**
+Keep your Explanation short and concise.
+
+**Important**: Only include clauses that conflict with one another, otherwise, just answer "No conflict".
+
+Context:
+{context}
+
+<Clauses>
+{clauses}
+</Clauses>
+Analytical Answer:"""
+
+
+def parse_clause_list(text, is_csv=False):
+  """
+  Return the clauses in pasted or uploaded text: one per line, or for CSV
+  the "clause" column if there is one, else the first column.
+  """
+
+  if not is_csv:
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+  rows = [row for row in csv.reader(io.StringIO(text)) if any(cell.strip() for cell in row)]
+  if not rows:
+    return []
+
+  header = [cell.strip().lower() for cell in rows[0]]
+  column = header.index("clause") if "clause" in header else 0
+  if "clause" in header:
+    rows = rows[1:]
+
+  return [row[column].strip() for row in rows if len(row) > column and row[column].strip()]
+
+  # End of parse_clause_list()
+
+
+def get_chunk_key(document):
+  return document.metadata.get("chunk_id") or document.page_content
+
+
+def group_by_context(contexts, budget=CONTEXT_TOKEN_BUDGET, max_size=CLAUSES_PER_PROMPT):
+  """
+  Group clauses whose retrieved chunks overlap, so that shared chunks are
+  sent once. `contexts` holds the retrieved documents of each clause; a
+  clause joins the group it shares the most chunks with, as long as the
+  group's context stays within `budget` tokens and `max_size` clauses.
+  Return (clause indexes, documents in file order) per group.
+  """
+
+  tokens = {}
+  for documents in contexts:
+    for document, count in zip(documents, count_tokens_batch([document.page_content for document in documents])):
+      tokens[get_chunk_key(document)] = count
+
+  groups = []
+  for n, documents in enumerate(contexts):
+    chunks = {get_chunk_key(document): document for document in documents}
+
+    best, best_overlap = None, 0
+    for group in groups:
+      if len(group["clauses"]) >= max_size:
+        continue
+      overlap = len(chunks.keys() & group["chunks"].keys())
+      if overlap <= best_overlap:
+        continue
+      extra = sum(tokens[key] for key in chunks.keys() - group["chunks"].keys())
+      if group["tokens"] + extra <= budget:
+        best, best_overlap = group, overlap
+
+    if best is None:
+      best = {"clauses": [], "chunks": {}, "tokens": 0}
+      groups.append(best)
+    best["tokens"] += sum(tokens[key] for key in chunks.keys() - best["chunks"].keys())
+    best["clauses"].append(n)
+    best["chunks"].update(chunks)
+
+  return [
+      (group["clauses"], sorted(group["chunks"].values(), key=lambda document: document.metadata.get("chunk", 0)))
+      for group in groups
+  ]
+
+  # End of group_by_context()
+
+
+def check_clauses(file_id, file_name, clauses, embeddings, use_cache=True, on_token=None):
+  """
+  Check many clauses against one file. `embeddings` are the clause
+  vectors, embedded once for all files. Clauses retrieving overlapping
+  context share a prompt. Return (rows of [clause, clause with conflicts,
+  explanation], True if served from the cache), or None if the file cannot
+  be indexed.
+  """
+
+  vector_db = get_file_index(file_id)
+  if vector_db is None:
+    return None
+
+  contexts = [
+      retrieve_context_by_vector(vector_db, embedding, CLAUSE_CONTEXT_TOKEN_BUDGET)
+      for embedding in embeddings
+  ]
+  groups = group_by_context(contexts)
+
+  prompts = [
+      CHECK_CLAUSES_TEMPLATE.format(
+          file_name=file_name,
+          context="\n\n".join(document.page_content for document in documents),
+          clauses="\n".join(f"{number}. {clauses[n]}" for number, n in enumerate(members, start=1)),
+      )
+      for members, documents in groups
+  ]
+  responses, cached = batch_cached(prompts, use_cache=use_cache, on_token=on_token)
+
+  rows = []
+  for (members, _), response in zip(groups, responses):
+    for row in get_table_rows(response):
+      number = re.search(r"\d+", row[1])
+      if number and 1 <= int(number.group()) <= len(members):
+        clause = clauses[members[int(number.group()) - 1]]
+      else:
+        clause = row[1]
+      rows.append([clause, row[2], " | ".join(row[3:])])
+
+  return rows, cached
+
+  # End of check_clauses()
+
+
+def embed_clauses(clauses):
+  """Embed every clause in one batched request."""
+
+  return helper.llm.embeddings_model.embed_documents(clauses)
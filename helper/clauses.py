@@ -0,0 +1,240 @@
+import re
+from collections import Counter
+
+from helper.database import execute_non_query, fetch_all, fetch_one, transaction
+
+# A numbered heading such as "3.2 Design Considerations" has at most this many words
+HEADING_MAX_WORDS = 12
+# Unnumbered text shorter than this is page furniture, e.g. "Page 3 of 14"
+MIN_CLAUSE_WORDS = 3
+# Lines this close to the top or bottom of a page may be headers, footers or page numbers
+RUNNING_LINE_SCAN = 6
+
+# "1.", "2)", "3.2", "3.2.1" or a number alone on its line
+NUMBER_MARKER = re.compile(r"(\d{1,3}(?:\.\d{1,3}){0,4})([.)])?(?=\s|$)")
+# "(a)", "a)", "a.", "(iv)", "iv)" or "IV."
+LETTER_MARKER = re.compile(r"(\()?([A-Za-z]|[ivxlc]{1,6}|[IVXLC]{1,6})(?(1)\)|[.)])(?=\s|$)")
+BULLET_MARKER = re.compile(r"[•●○◦▪■□‣∙·➢✓*\-–—](?=\s|$)")
+# Table of contents entry, e.g. "SCOPE OF WORK ........ 5"
+CONTENTS_LINE = re.compile(r"\.{4,}\s*\d+$")
+SENTENCE_ENDINGS = (".", ";", ":", ",", "?", "!")
+
+
+def find_marker(line):
+  """
+  Return (kind, label, rest of line) if a line starts a clause, else None.
+  The kind tells nesting levels apart: numbers by depth, letters by case
+  and punctuation, and bullets by symbol.
+  """
+
+  match = NUMBER_MARKER.match(line)
+  if match:
+    rest = line[match.end():].strip()
+    # "30 days" in wrapped text is not a clause; "1." and a number alone are
+    if "." in match.group(1) or match.group(2) or not rest:
+      return ("number", match.group(1).count(".") + 1), match.group(0), rest
+
+  match = LETTER_MARKER.match(line)
+  if match:
+    label = match.group(2)
+    style = (label.islower(), match.group(1) is not None, match.group(0)[-1])
+    return ("roman" if len(label) > 1 else "letter", style), match.group(0), line[match.end():].strip()
+
+  match = BULLET_MARKER.match(line)
+  if match:
+    return ("bullet", match.group(0)), match.group(0), line[match.end():].strip()
+
+  return None
+
+  # End of find_marker()
+
+
+def get_page_lines(pages):
+  """
+  Return the stripped lines of every page without running headers and
+  footers, page numbers, table of contents entries and the blank lines
+  around them. Running lines are those near the top or bottom of at least
+  half the pages.
+  """
+
+  windows = []
+  for text in pages:
+    lines = [line.strip() for line in text.splitlines()]
+    filled = [n for n, line in enumerate(lines) if line]
+    windows.append((lines, set(filled[:RUNNING_LINE_SCAN] + filled[-RUNNING_LINE_SCAN:])))
+
+  counts = Counter()
+  for lines, window in windows:
+    counts.update({" ".join(lines[n].split()) for n in window})
+  running = {line for line, count in counts.items() if len(pages) >= 3 and count >= len(pages) / 2}
+
+  page_lines = []
+  for page, (lines, window) in enumerate(windows):
+    lines = [
+        line for n, line in enumerate(lines)
+        if not (n in window and (" ".join(line.split()) in running or line in (str(page), str(page + 1))))
+        and not CONTENTS_LINE.search(line)
+    ]
+    # Blank lines at a page break do not end a clause
+    while lines and not lines[-1]:
+      lines.pop()
+    while lines and not lines[0]:
+      lines.pop(0)
+    page_lines.append(lines)
+  return page_lines
+
+  # End of get_page_lines()
+
+
+def split_clauses(pages):
+  """
+  Split the text of a document into clauses: the sentences under one
+  number, letter or bullet, with the lettered and bulleted items and
+  unnumbered text that follow it, or one paragraph of unnumbered text. A
+  clause may run across pages. Numbered headings are not clauses but make
+  up the section path of the clauses below them, e.g. "3 GENERAL
+  REQUIREMENTS > 3.2 Design Considerations". Return dicts of page,
+  section, number and text in document order.
+  """
+
+  clauses = []
+  # [kind, label, is heading, clause holding its text] of the open headings
+  # and clauses, outermost first
+  stack = []
+  current = None
+  # Marker alone on its line, waiting for the text after it
+  pending = None
+
+  def resolve_kind(kind, label):
+    # "i", "v" and "x" continue a list of roman numerals or of letters, or start roman numerals
+    letter = label.strip("().").lower()
+    if kind[0] != "letter" or letter not in ("i", "v", "x"):
+      return kind
+    if ("roman", kind[1]) in [entry[0] for entry in stack]:
+      return "roman", kind[1]
+    if [kind, chr(ord(letter) - 1)] in [[entry[0], entry[1].lower()] for entry in stack]:
+      return kind
+    return ("roman", kind[1]) if letter == "i" else kind
+
+  def open_clause(page, marker, text):
+    kind, label = resolve_kind(marker[0], marker[1]), marker[1]
+    if kind[0] == "number":
+      # A number closes everything down to a shallower number
+      while stack and stack[-1][0][0] != "title" and not (stack[-1][0][0] == "number" and stack[-1][0][1] < kind[1]):
+        stack.pop()
+    elif kind in [entry[0] for entry in stack]:
+      while stack.pop()[0] != kind:
+        pass
+    stack.append([kind, label.strip("()."), False, None])
+    return {"page": page, "kind": kind, "number": label, "lines": [text]}
+
+  def close_clause(clause):
+    body = join_lines(clause["lines"])
+    kind = clause["kind"]
+
+    if kind is None:
+      if body.isupper() and len(body.split()) <= HEADING_MAX_WORDS:
+        # An unnumbered title in capitals starts a new part of the document
+        stack[:] = [[("title",), body, True, None]]
+      elif stack and not stack[-1][2]:
+        # Unnumbered text after a clause carries it on
+        stack[-1][3]["text"] += f" {body}"
+      elif len(body.split()) >= MIN_CLAUSE_WORDS:
+        clauses.append({"page": clause["page"], "section": get_section(stack), "number": "", "text": body})
+    elif kind[0] == "number" and len(body.split()) <= HEADING_MAX_WORDS and not body.endswith(SENTENCE_ENDINGS):
+      stack[-1][1:3] = [f"{stack[-1][1]} {body}", True]
+    elif kind[0] != "number" and len(stack) > 1 and not stack[-2][2]:
+      # A lettered or bulleted item is part of the clause that introduces it
+      stack[-2][3]["text"] += f" {clause['number']} {body}"
+      stack[-1][3] = stack[-2][3]
+    else:
+      stack[-1][3] = {
+          "page": clause["page"],
+          "section": get_section(stack[:-1]),
+          "number": clause["number"],
+          "text": f"{clause['number']} {body}",
+      }
+      clauses.append(stack[-1][3])
+
+  for page, lines in enumerate(get_page_lines(pages)):
+    # Numbered clauses run on across a page break; titles and unnumbered text do not
+    if current and current["kind"] is None:
+      close_clause(current)
+      current = None
+
+    for line in lines:
+      marker = find_marker(line) if line else None
+      if marker and not marker[2]:
+        # Wait for its text; a second marker in a row means this one was not a clause
+        pending = (page, marker)
+        continue
+
+      if marker or (pending and line):
+        if current:
+          close_clause(current)
+        current = open_clause(*pending, line) if not marker else open_clause(page, marker, marker[2])
+        pending = None
+      elif not line:
+        if current:
+          close_clause(current)
+          current = None
+      elif current is None:
+        current = {"page": page, "kind": None, "number": "", "lines": [line]}
+      else:
+        current["lines"].append(line)
+
+  if current:
+    close_clause(current)
+
+  return clauses
+
+  # End of split_clauses()
+
+
+def get_section(entries):
+  return " > ".join(entry[1] for entry in entries)
+
+
+def join_lines(lines):
+  """Join wrapped lines, mending words hyphenated across a line break."""
+
+  text = ""
+  for line in lines:
+    if text.endswith("-") and not text.endswith(" -"):
+      text += line
+    else:
+      text += f" {line}" if text else line
+  return " ".join(text.split())
+
+
+def save_clauses(file_id, blob_hash, clauses):
+  """
+  Replace the stored clauses of a file with those split from the content
+  `blob_hash`, unless the file has been deleted.
+  """
+
+  with transaction() as conn:
+    if not fetch_one("SELECT 1 FROM Files WHERE file_id = ?", [file_id]):
+      return
+    conn.execute("DELETE FROM Clauses WHERE file_id = ?", [file_id])
+    conn.cursor().executemany(
+        "INSERT INTO Clauses (file_id, position, page, section, number, text, blob_hash) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (file_id, position, clause["page"], clause["section"], clause["number"], clause["text"], blob_hash)
+            for position, clause in enumerate(clauses)
+        ],
+    )
+
+
+def delete_clauses(file_id):
+  execute_non_query("DELETE FROM Clauses WHERE file_id = ?", [file_id])
+
+
+def get_clauses(file_id, blob_hash):
+  """Return the stored clauses of a file split from the content `blob_hash`, in document order."""
+
+  data = fetch_all(
+      "SELECT page, section, number, text FROM Clauses WHERE file_id = ? AND blob_hash = ? ORDER BY position ASC",
+      [file_id, blob_hash],
+  )
+  return [{"page": row[0], "section": row[1], "number": row[2], "text": row[3]} for row in data]
@@ -0,0 +1,264 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from helper.clauses import get_clauses
+from helper.index import get_file_index
+from helper.llm import count_tokens_batch
+from helper.llm_cache import batch_cached
+from helper.tracing import in_current_run, span
+
+# Most related clause pairs sent to the LLM per file
+CONFLICT_TOP_K_PAIRS = 40
+# Clause pairs compared in one prompt
+PAIRS_PER_PROMPT = 8
+# Rows of the similarity matrix computed at a time
+SIMILARITY_BLOCK_SIZE = 1024
+# Tokens of clause pairs per cross-file comparison prompt
+REDUCE_TOKEN_BUDGET = 3000
+# Cross-file clause pairs compared per clause
+CROSS_FILE_PAIRS_PER_CLAUSE = 1
+
+CONFLICT_PAIRS_TEMPLATE = """The provided context comes from a set of Tender documents. If you don't know the answer, simply state that you don't know — do not attempt to create an answer.
+
+Clauses refer to the one or more sentences within one bullet point of the context you are given.
+
+**Role**: You are a Procurement Specialist.
+**Goal**: Determine whether the clauses in each numbered pair below conflict with each other.
+**Backstory**: The pairs were picked from the Tender documents because they cover related topics.
+
+**Task**:
+1. For each pair, compare every clause in Source 1 against every clause in Source 2.
+2. If any conflicts are found, list the conflicting clauses in a table format. Include the following columns:
+- S/N
+- **Source 1**
+- **Source 2**
+- **Explanation**
+Keep your Explanation short and concise.
+
+**Important**: Only include clauses that conflict with one another, otherwise, just answer "No conflict".
+
+{pairs}
+Analytical Answer:"""
+
+CONFLICT_TABLE_HEADER = "| S/N | **Source 1** | **Source 2** | **Explanation** |\n|---|---|---|---|"
+
+
+def get_file_chunks(file_id):
+  """
+  Return the chunks of a file in document order, each headed by the section
+  path and page of its clause as stored in Clauses, their embeddings as a
+  float32 matrix and the position of the clause each chunk belongs to, or
+  (None, None, None) if the file cannot be indexed or is being re-indexed.
+  """
+
+  vector_db = get_file_index(file_id)
+  if vector_db is None:
+    return None, None, None
+
+  data = vector_db._collection.get(include=["embeddings", "documents", "metadatas"])
+  # Chunk ids are "<file_id>-<position>"
+  order = sorted(range(len(data["ids"])), key=lambda n: int(data["ids"][n].rsplit("-", 1)[1]))
+  clauses = np.asarray([data["metadatas"][n]["clause"] for n in order])
+  # Chunks and clauses of different content mean the file is being indexed again
+  blob_hashes = {metadata.get("blob_hash") for metadata in data["metadatas"]}
+  stored = get_clauses(file_id, blob_hashes.pop()) if len(blob_hashes) == 1 else []
+  if not stored or clauses.max() >= len(stored):
+    return None, None, None
+  documents = [
+      f"({get_location(stored[clause])}) {data['documents'][n]}"
+      for n, clause in zip(order, clauses.tolist())
+  ]
+  matrix = np.asarray(data["embeddings"], dtype=np.float32)[order]
+
+  return documents, matrix, clauses
+
+  # End of get_file_chunks()
+
+
+def get_location(clause):
+  """Return where a clause is, e.g. "3 GENERAL > 3.2 Design, page 4"."""
+
+  page = f"page {clause['page'] + 1}"
+  return f"{clause['section']}, {page}" if clause["section"] else page
+
+
+def top_similar_pairs(matrix, top_k, groups=None, block_size=SIMILARITY_BLOCK_SIZE):
+  """
+  Return up to `top_k` pairs (i, j), i < j, with the highest cosine
+  similarity, most similar first. Without `groups`, neighbouring chunks are
+  skipped as they share overlapping text; with a group id per row, only
+  pairs from different groups are kept. The matrix is processed
+  `block_size` rows at a time so memory stays bounded for large files.
+  """
+
+  norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+  unit = matrix / np.maximum(norms, 1e-12)
+  total = len(unit)
+
+  best_scores = np.empty(0, dtype=np.float32)
+  best_pairs = np.empty((0, 2), dtype=np.int64)
+  columns = np.arange(total)[None, :]
+
+  for start in range(0, total, block_size):
+    scores = unit[start:start + block_size] @ unit.T
+    rows = np.arange(start, start + len(scores))[:, None]
+    if groups is None:
+      scores[columns <= rows + 1] = -np.inf
+    else:
+      scores[(columns <= rows) | (groups[start:start + len(scores)][:, None] == groups[None, :])] = -np.inf
+
+    flat = scores.ravel()
+    k = min(top_k, flat.size)
+    if k == 0:
+      continue
+    candidates = np.argpartition(flat, -k)[-k:]
+    best_scores = np.concatenate([best_scores, flat[candidates]])
+    best_pairs = np.concatenate([
+        best_pairs,
+        np.stack([start + candidates // total, candidates % total], axis=1),
+    ])
+
+    if len(best_scores) > top_k:
+      keep = np.argpartition(best_scores, -top_k)[-top_k:]
+      best_scores, best_pairs = best_scores[keep], best_pairs[keep]
+
+  keep = np.isfinite(best_scores)
+  best_scores, best_pairs = best_scores[keep], best_pairs[keep]
+  order = np.argsort(-best_scores, kind="stable")
+
+  return [tuple(pair) for pair in best_pairs[order].tolist()]
+
+  # End of top_similar_pairs()
+
+
+def format_pairs(pairs):
+  """Format (source 1, source 2) text pairs for CONFLICT_PAIRS_TEMPLATE."""
+
+  return "\n\n".join(
+      f"<Pair {n}>\nSource 1:\n{source_1}\n\nSource 2:\n{source_2}\n</Pair {n}>"
+      for n, (source_1, source_2) in enumerate(pairs, start=1)
+  )
+
+
+def pack_by_tokens(items, budget, key=str):
+  """
+  Group consecutive items into batches whose `key(item)` texts add up to at
+  most `budget` tokens. An item over the budget gets a batch of its own.
+  """
+
+  batches = []
+  batch, used = [], 0
+  for item, tokens in zip(items, count_tokens_batch([key(item) for item in items])):
+    if batch and used + tokens > budget:
+      batches.append(batch)
+      batch, used = [], 0
+    batch.append(item)
+    used += tokens
+
+  if batch:
+    batches.append(batch)
+  return batches
+
+  # End of pack_by_tokens()
+
+
+def get_table_rows(answer):
+  """Return the data rows of the markdown table(s) in an answer."""
+
+  rows = []
+  for line in answer.splitlines():
+    line = line.strip()
+    if not line.startswith("|") or line.count("|") < 5:
+      continue
+    if re.fullmatch(r"[|\-:\s]+", line) or "S/N" in line:
+      continue
+    rows.append([cell.strip() for cell in line.strip("|").split("|")])
+  return rows
+
+
+def merge_answers(answers):
+  """Combine the tables of several answers into one, renumbering S/N."""
+
+  rows = [row for answer in answers for row in get_table_rows(answer)]
+  if not rows:
+    return "No conflict"
+
+  lines = [CONFLICT_TABLE_HEADER]
+  for n, row in enumerate(rows, start=1):
+    lines.append("| " + " | ".join([str(n)] + row[1:]) + " |")
+  return "\n".join(lines)
+
+
+def find_conflicts(file_id, use_cache=True, on_token=None):
+  """
+  Find conflicting clauses across a whole file. Every clause embedding is
+  compared with every other, and only the most related pairs are sent to
+  the LLM, PAIRS_PER_PROMPT pairs per prompt. The answers are streamed to
+  `on_token` as they are generated. Return (merged answer, True if served
+  from the cache), or None if the file cannot be indexed.
+  """
+
+  documents, matrix, clauses = get_file_chunks(file_id)
+  if documents is None:
+    return None
+
+  with span("similarity"):
+    # Parts of one long clause are not compared with each other
+    pairs = top_similar_pairs(matrix, CONFLICT_TOP_K_PAIRS, groups=clauses)
+  if not pairs:
+    return "No conflict", False
+
+  pairs = [(documents[i], documents[j]) for i, j in pairs]
+  prompts = [
+      CONFLICT_PAIRS_TEMPLATE.format(pairs=format_pairs(pairs[start:start + PAIRS_PER_PROMPT]))
+      for start in range(0, len(pairs), PAIRS_PER_PROMPT)
+  ]
+  responses, cached = batch_cached(prompts, use_cache=use_cache, on_token=on_token)
+
+  return merge_answers(responses), cached
+
+  # End of find_conflicts()
+
+
+def find_cross_file_conflicts(files_dict, use_cache=True, on_token=None):
+  """
+  Find conflicting clauses between different files. The clauses of every
+  file, their embeddings and locations are read in parallel; each
+  clause is paired with its most similar clauses from other files, and the
+  pairs are compared in prompts of at most REDUCE_TOKEN_BUDGET tokens,
+  streaming the answers to `on_token` as they are generated. Return
+  (merged answer, True if the comparison was served from the cache), or
+  None if a file cannot be indexed.
+  """
+
+  with ThreadPoolExecutor(max_workers=max(1, len(files_dict))) as executor:
+    chunks = dict(zip(files_dict, executor.map(in_current_run(get_file_chunks), files_dict)))
+  if any(documents is None for documents, _, _ in chunks.values()):
+    return None
+
+  sources = [
+      f"{files_dict[file_id]}: {document}"
+      for file_id in files_dict for document in chunks[file_id][0]
+  ]
+  groups = np.asarray([file_id for file_id in files_dict for _ in chunks[file_id][0]])
+  if len(set(groups.tolist())) < 2:
+    return "No conflict", False
+
+  matrix = np.concatenate([chunks[file_id][1] for file_id in files_dict])
+  with span("similarity"):
+    pairs = top_similar_pairs(matrix, CROSS_FILE_PAIRS_PER_CLAUSE * len(sources), groups=groups)
+  if not pairs:
+    return "No conflict", False
+
+  pairs = [(sources[i], sources[j]) for i, j in pairs]
+  prompts = [
+      CONFLICT_PAIRS_TEMPLATE.format(pairs=format_pairs(batch))
+      for batch in pack_by_tokens(pairs, REDUCE_TOKEN_BUDGET, key=lambda pair: format_pairs([pair]))
+  ]
+  responses, cached = batch_cached(prompts, use_cache=use_cache, on_token=on_token)
+
+  return merge_answers(responses), cached
+
+  # End of find_cross_file_conflicts()
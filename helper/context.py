@@ -0,0 +1,54 @@
+from helper.llm import count_tokens_batch
+from helper.tracing import span
+from helper.utility import get_secret_value
+
+# Tokens of retrieved chunks per prompt
+CONTEXT_TOKEN_BUDGET = int(get_secret_value("CONTEXT_TOKEN_BUDGET") or 3000)
+# Chunks picked by MMR, in order of preference, before packing
+MMR_CANDIDATES = 20
+# Most similar chunks MMR chooses from
+MMR_FETCH_K = 60
+# 1 favours relevance, 0 favours diversity
+MMR_LAMBDA = 0.5
+
+
+def pack_documents(documents, budget=CONTEXT_TOKEN_BUDGET):
+  """
+  Keep documents in the given order of preference while their text fits
+  in `budget` tokens, then return them in the order they appear in the
+  file. A document that does not fit is skipped so smaller ones can still
+  use the remaining budget.
+  """
+
+  packed, used = [], 0
+  for document, tokens in zip(documents, count_tokens_batch([document.page_content for document in documents])):
+    if used + tokens > budget:
+      continue
+    packed.append(document)
+    used += tokens
+
+  return sorted(packed, key=lambda document: document.metadata.get("chunk", 0))
+
+  # End of pack_documents()
+
+
+def retrieve_context(vector_db, query, budget=CONTEXT_TOKEN_BUDGET):
+  """
+  Retrieve chunks relevant to a query with maximal marginal relevance, so
+  near-duplicate chunks are not sent twice, and pack them into `budget`
+  tokens in document order.
+  """
+
+  return retrieve_context_by_vector(vector_db, vector_db.embeddings.embed_query(query), budget)
+
+
+def retrieve_context_by_vector(vector_db, embedding, budget=CONTEXT_TOKEN_BUDGET):
+  """As `retrieve_context`, for a query that is already embedded."""
+
+  with span("retrieve"):
+    documents = vector_db.max_marginal_relevance_search_by_vector(
+        embedding, k=MMR_CANDIDATES, fetch_k=MMR_FETCH_K, lambda_mult=MMR_LAMBDA,
+    )
+  return pack_documents(documents, budget)
+
+  # End of retrieve_context_by_vector()
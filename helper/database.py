@@ -1,27 +1,86 @@
 import os
 import sqlite3
+import threading
+from contextlib import contextmanager
 
+from helper.tracing import span
 from helper.utility import get_secret_value
 
 DATABASE_FOLDER = os.path.join(os.getcwd(), "database")
 DATABASE_NAME = get_secret_value("DATABASE_NAME")
 DATABASE_PATH = os.path.join(DATABASE_FOLDER, DATABASE_NAME)
+BUSY_TIMEOUT_IN_MS = 10000
+# Free pages worth returning to the file system, about 10 MB of 4 KiB pages
+VACUUM_MIN_FREE_PAGES = 2560
 
 if not os.path.exists(DATABASE_FOLDER):
   os.makedirs(DATABASE_FOLDER)
 
 
+# Per-thread connection and transaction depth
+local = threading.local()
+
+PRAGMAS = [
+    # Only takes effect on a new database, so it must come first; see compact_database()
+    "PRAGMA auto_vacuum = INCREMENTAL",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA busy_timeout = {BUSY_TIMEOUT_IN_MS}",
+    "PRAGMA cache_size = -20000",  # in KiB
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA foreign_keys = ON",
+]
+
+
 # Get connection
 def get_connection():
-  conn = sqlite3.connect(DATABASE_PATH)
+  """
+  Return this thread's connection, opening and tuning it on first use.
+  Connections are in autocommit mode; use `transaction()` to group writes.
+  """
+
+  conn = getattr(local, "conn", None)
+  if conn is None:
+    conn = sqlite3.connect(DATABASE_PATH, timeout=BUSY_TIMEOUT_IN_MS / 1000, isolation_level=None)
+    for pragma in PRAGMAS:
+      conn.execute(pragma)
+    local.conn = conn
+    local.depth = 0
+
   return conn
 
 
-# Execute Non Query
-def execute_non_query(query, parameters=None):
+@contextmanager
+def transaction():
+  """
+  Run the enclosed statements on this thread's connection in one
+  transaction, committed once at the end. Nested uses join the outer one.
+  """
+
   conn = get_connection()
+  if local.depth == 0:
+    conn.execute("BEGIN IMMEDIATE")
+  local.depth += 1
+
+  try:
+    yield conn
+  except BaseException:
+    local.depth -= 1
+    if local.depth == 0:
+      conn.execute("ROLLBACK")
+    raise
+
+  local.depth -= 1
+  if local.depth == 0:
+    conn.execute("COMMIT")
 
-  with conn:
+  # End of transaction()
+
+
+# Execute Non Query
+def execute_non_query(query, parameters=None):
+  with span("db"), transaction() as conn:
     cursor = conn.cursor()
     if parameters is None:
       cursor.execute(query)
@@ -35,78 +94,367 @@ def execute_non_query(query, parameters=None):
 
 # Fetch one
 def fetch_one(query, parameters=None):
-  conn = get_connection()
-
-  with conn:
-    cursor = conn.cursor()
+  with span("db"):
+    cursor = get_connection().cursor()
     if parameters is None:
       cursor.execute(query)
     else:
       cursor.execute(query, parameters)
     data = cursor.fetchone()
+    # Reset the statement so that no read transaction is left open
+    cursor.close()
 
   return data
 
 
 # Fetch all
 def fetch_all(query, parameters=None):
-  conn = get_connection()
-
-  with conn:
-    cursor = conn.cursor()
+  with span("db"):
+    cursor = get_connection().cursor()
     if parameters is None:
       cursor.execute(query)
     else:
       cursor.execute(query, parameters)
     rows = cursor.fetchall()
+    cursor.close()
 
   return rows
 
 
+def migrate_v1(cursor):
+  """
+  Schema as it was before versioning. Every statement is idempotent, as
+  unversioned databases may already hold any part of it.
+  """
+
+  # Create Configuration table
+  cursor.execute("""
+      CREATE TABLE IF NOT EXISTS Configuration (
+          configuration_id INTEGER PRIMARY KEY AUTOINCREMENT,
+          key TEXT NOT NULL,
+          creation_date TIMESTAMP DEFAULT (DATETIME(CURRENT_TIMESTAMP, '+8 hours')) NOT NULL
+      )
+  """)
+  cursor.execute("""
+      INSERT INTO Configuration (key)
+        SELECT 'setup_on'
+        WHERE NOT EXISTS (SELECT 1 FROM Configuration WHERE key = 'setup_on')
+  """)
+
+  # Create Repository table
+  cursor.execute("""
+      CREATE TABLE IF NOT EXISTS Repository (
+          repository_id TEXT PRIMARY KEY,
+          name TEXT NOT NULL,
+          creation_date TIMESTAMP DEFAULT (DATETIME(CURRENT_TIMESTAMP, '+8 hours')) NOT NULL,
+          modification_date TIMESTAMP DEFAULT (DATETIME(CURRENT_TIMESTAMP, '+8 hours')) NOT NULL
+      )
+  """)
+
+  # Create Files table
+  cursor.execute("""
+      CREATE TABLE IF NOT EXISTS Files (
+          file_id INTEGER PRIMARY KEY AUTOINCREMENT,
+          repository_id TEXT NOT NULL,
+          file_name TEXT NOT NULL,
+          type TEXT NOT NULL,
+          size INTEGER NOT NULL,
+          data BLOB NOT NULL,
+          blob_hash TEXT,
+          FOREIGN KEY (repository_id) REFERENCES Repository(repository_id) ON DELETE CASCADE
+      )
+  """)
+  # Files created before the blob store kept their content inline in data
+  cursor.execute("PRAGMA table_info(Files)")
+  if "blob_hash" not in [column[1] for column in cursor.fetchall()]:
+    cursor.execute("ALTER TABLE Files ADD COLUMN blob_hash TEXT")
+  cursor.execute("""
+      CREATE INDEX IF NOT EXISTS idx_files_blob_hash ON Files (blob_hash)
+  """)
+
+  # Create Blobs table; ref_count is maintained by the triggers on Files
+  cursor.execute("""
+      CREATE TABLE IF NOT EXISTS Blobs (
+          blob_hash TEXT PRIMARY KEY,
+          size INTEGER NOT NULL,
+          ref_count INTEGER DEFAULT 0 NOT NULL
+      )
+  """)
+  cursor.execute("""
+      CREATE TRIGGER IF NOT EXISTS trg_files_blob_insert AFTER INSERT ON Files
+      BEGIN
+          UPDATE Blobs SET ref_count = ref_count + 1 WHERE blob_hash = NEW.blob_hash;
+      END
+  """)
+  cursor.execute("""
+      CREATE TRIGGER IF NOT EXISTS trg_files_blob_update AFTER UPDATE OF blob_hash ON Files
+      BEGIN
+          UPDATE Blobs SET ref_count = ref_count - 1 WHERE blob_hash = OLD.blob_hash;
+          UPDATE Blobs SET ref_count = ref_count + 1 WHERE blob_hash = NEW.blob_hash;
+      END
+  """)
+  cursor.execute("""
+      CREATE TRIGGER IF NOT EXISTS trg_files_blob_delete AFTER DELETE ON Files
+      BEGIN
+          UPDATE Blobs SET ref_count = ref_count - 1 WHERE blob_hash = OLD.blob_hash;
+      END
+  """)
+
+  # Create Jobs table
+  cursor.execute("""
+      CREATE TABLE IF NOT EXISTS Jobs (
+          job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+          file_id INTEGER NOT NULL,
+          status TEXT NOT NULL,
+          progress REAL DEFAULT 0 NOT NULL,
+          message TEXT,
+          creation_date TIMESTAMP DEFAULT (DATETIME(CURRENT_TIMESTAMP, '+8 hours')) NOT NULL,
+          modification_date TIMESTAMP DEFAULT (DATETIME(CURRENT_TIMESTAMP, '+8 hours')) NOT NULL,
+          FOREIGN KEY (file_id) REFERENCES Files(file_id) ON DELETE CASCADE
+      )
+  """)
+  cursor.execute("""
+      CREATE INDEX IF NOT EXISTS idx_jobs_status ON Jobs (status, job_id)
+  """)
+  cursor.execute("""
+      CREATE INDEX IF NOT EXISTS idx_jobs_file_id ON Jobs (file_id)
+  """)
+
+  # Create EmbeddingCache table
+  cursor.execute("""
+      CREATE TABLE IF NOT EXISTS EmbeddingCache (
+          key TEXT PRIMARY KEY,
+          model TEXT NOT NULL,
+          vector BLOB NOT NULL,
+          last_used REAL NOT NULL
+      )
+  """)
+  cursor.execute("""
+      CREATE INDEX IF NOT EXISTS idx_embedding_cache_last_used ON EmbeddingCache (last_used)
+  """)
+
+  # End of migrate_v1()
+
+
+def summarise_files_of(repository_id):
+  """SQL to refresh the denormalised file summary of one repository."""
+
+  return f"""
+            UPDATE Repository
+            SET file_count = (SELECT COUNT(*) FROM Files WHERE repository_id = {repository_id}),
+                file_names = COALESCE((SELECT group_concat(file_name, ', ') FROM Files WHERE repository_id = {repository_id}), '')
+            WHERE repository_id = {repository_id};"""
+
+
+def migrate_v2(cursor):
+  """Index Files by repository and keep a file summary on each Repository."""
+
+  cursor.execute("""
+      CREATE INDEX IF NOT EXISTS idx_files_repository_id ON Files (repository_id, file_name)
+  """)
+  cursor.execute("""
+      CREATE INDEX IF NOT EXISTS idx_repository_creation_date ON Repository (creation_date)
+  """)
+
+  cursor.execute("ALTER TABLE Repository ADD COLUMN file_count INTEGER DEFAULT 0 NOT NULL")
+  cursor.execute("ALTER TABLE Repository ADD COLUMN file_names TEXT DEFAULT '' NOT NULL")
+  cursor.execute(f"""
+      CREATE TRIGGER trg_files_summary_insert AFTER INSERT ON Files
+      BEGIN{summarise_files_of("NEW.repository_id")}
+      END
+  """)
+  cursor.execute(f"""
+      CREATE TRIGGER trg_files_summary_update AFTER UPDATE OF repository_id, file_name ON Files
+      BEGIN{summarise_files_of("OLD.repository_id")}{summarise_files_of("NEW.repository_id")}
+      END
+  """)
+  cursor.execute(f"""
+      CREATE TRIGGER trg_files_summary_delete AFTER DELETE ON Files
+      BEGIN{summarise_files_of("OLD.repository_id")}
+      END
+  """)
+  cursor.execute(summarise_files_of("Repository.repository_id"))
+
+  # End of migrate_v2()
+
+
+def migrate_v3(cursor):
+  """Cache the extracted text of each stored file, page by page."""
+
+  cursor.execute("""
+      CREATE TABLE ParsedText (
+          blob_hash TEXT NOT NULL,
+          page INTEGER NOT NULL,
+          text TEXT NOT NULL,
+          PRIMARY KEY (blob_hash, page)
+      ) WITHOUT ROWID
+  """)
+
+  # End of migrate_v3()
+
+
+def migrate_v4(cursor):
+  """Cache LLM responses by a hash of everything that shapes them."""
+
+  cursor.execute("""
+      CREATE TABLE LLMCache (
+          key TEXT PRIMARY KEY,
+          model TEXT NOT NULL,
+          response TEXT NOT NULL,
+          creation_time REAL NOT NULL,
+          last_used REAL NOT NULL
+      )
+  """)
+  cursor.execute("""
+      CREATE INDEX idx_llm_cache_last_used ON LLMCache (last_used)
+  """)
+
+  # End of migrate_v4()
+
+
+def migrate_v5(cursor):
+  """Record how long each stage of a user action took and what it cost."""
+
+  cursor.execute("""
+      CREATE TABLE Metrics (
+          metric_id INTEGER PRIMARY KEY AUTOINCREMENT,
+          run_id TEXT NOT NULL,
+          run_name TEXT NOT NULL,
+          repository_id TEXT,
+          stage TEXT NOT NULL,
+          duration REAL NOT NULL,
+          prompt_tokens INTEGER,
+          completion_tokens INTEGER,
+          creation_time REAL NOT NULL
+      )
+  """)
+  cursor.execute("""
+      CREATE INDEX idx_metrics_creation_time ON Metrics (creation_time)
+  """)
+  cursor.execute("""
+      CREATE INDEX idx_metrics_stage ON Metrics (stage, creation_time)
+  """)
+
+  # End of migrate_v5()
+
+
+def migrate_v6(cursor):
+  """Track when each file's vector index was last used, for eviction."""
+
+  cursor.execute("""
+      CREATE TABLE FileIndexes (
+          file_id INTEGER PRIMARY KEY,
+          last_used REAL NOT NULL,
+          FOREIGN KEY (file_id) REFERENCES Files(file_id) ON DELETE CASCADE
+      )
+  """)
+  cursor.execute("""
+      CREATE INDEX idx_file_indexes_last_used ON FileIndexes (last_used)
+  """)
+
+  # End of migrate_v6()
+
+
+def migrate_v7(cursor):
+  """Keep the clauses each file is split into, with their section path and page."""
+
+  cursor.execute("""
+      CREATE TABLE Clauses (
+          file_id INTEGER NOT NULL,
+          position INTEGER NOT NULL,
+          page INTEGER NOT NULL,
+          section TEXT NOT NULL,
+          number TEXT NOT NULL,
+          text TEXT NOT NULL,
+          PRIMARY KEY (file_id, position),
+          FOREIGN KEY (file_id) REFERENCES Files(file_id) ON DELETE CASCADE
+      ) WITHOUT ROWID
+  """)
+
+  # End of migrate_v7()
+
+
+def migrate_v8(cursor):
+  """Record embedding cache hits and misses alongside the embed stage."""
+
+  cursor.execute("ALTER TABLE Metrics ADD COLUMN cache_hits INTEGER")
+  cursor.execute("ALTER TABLE Metrics ADD COLUMN cache_misses INTEGER")
+
+  # End of migrate_v8()
+
+
+def migrate_v9(cursor):
+  """
+  Record which content of a file its clauses were split from, so they are
+  never read with the index of another version. Clauses stored before are
+  left without one and rebuilt on first use.
+  """
+
+  cursor.execute("ALTER TABLE Clauses ADD COLUMN blob_hash TEXT")
+
+  # End of migrate_v9()
+
+
+# Schema version N is reached by applying MIGRATIONS[N - 1]
+MIGRATIONS = [
+    migrate_v1, migrate_v2, migrate_v3, migrate_v4, migrate_v5, migrate_v6, migrate_v7, migrate_v8, migrate_v9,
+]
+
+
+def vacuum_database():
+  """
+  Return free pages to the file system once there are at least
+  VACUUM_MIN_FREE_PAGES of them. Only databases in incremental auto-vacuum
+  mode are vacuumed, as that frees pages without locking the database for
+  long; older ones are switched by `compact_database`. Run it off the
+  request path, outside any transaction.
+  """
+
+  conn = get_connection()
+  # 2 is INCREMENTAL
+  if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+    return
+  if conn.execute("PRAGMA freelist_count").fetchone()[0] < VACUUM_MIN_FREE_PAGES:
+    return
+
+  # Run to completion; a plain execute() frees a single page
+  conn.executescript("PRAGMA incremental_vacuum;")
+  # Shrink the write-ahead log too, which otherwise keeps its largest size
+  conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+  # End of vacuum_database()
+
+
+def compact_database():
+  """
+  Switch a database created before incremental auto-vacuum to it, so that
+  `vacuum_database` can reclaim its free pages from then on. This takes
+  one full VACUUM, which locks the database throughout; run it while the
+  app is stopped.
+  """
+
+  conn = get_connection()
+  conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+  conn.execute("VACUUM")
+
+  # End of compact_database()
+
+
 # Create database if does not exist
 def create_db():
-  conn = get_connection()
+  """Bring the schema up to the latest version; cheap when already there."""
+
+  if fetch_one("PRAGMA user_version")[0] >= len(MIGRATIONS):
+    return
 
-  with conn:
+  with transaction() as conn:
     cursor = conn.cursor()
+    # Re-read under the write lock in case another session migrated first
+    cursor.execute("PRAGMA user_version")
+    version = cursor.fetchone()[0]
 
-    # Create Configuration table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Configuration (
-            configuration_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            key TEXT NOT NULL,
-            creation_date TIMESTAMP DEFAULT (DATETIME(CURRENT_TIMESTAMP, '+8 hours')) NOT NULL
-        )
-    """)
-    cursor.execute("""
-        INSERT INTO Configuration (key)
-          SELECT 'setup_on'
-          WHERE NOT EXISTS (SELECT 1 FROM Configuration WHERE key = 'setup_on')
-    """)
-
-    # Create Repository table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Repository (
-            repository_id TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            creation_date TIMESTAMP DEFAULT (DATETIME(CURRENT_TIMESTAMP, '+8 hours')) NOT NULL,
-            modification_date TIMESTAMP DEFAULT (DATETIME(CURRENT_TIMESTAMP, '+8 hours')) NOT NULL
-        )
-    """)
-
-    # Create Files table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Files (
-            file_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            repository_id TEXT NOT NULL,
-            file_name TEXT NOT NULL,
-            type TEXT NOT NULL,
-            size INTEGER NOT NULL,
-            data BLOB NOT NULL,
-            FOREIGN KEY (repository_id) REFERENCES Repository(repository_id) ON DELETE CASCADE
-        )
-    """)
-
-    conn.commit()
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+      migration(cursor)
+      cursor.execute(f"PRAGMA user_version = {number}")
 
   # End of create_db()
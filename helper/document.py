@@ -0,0 +1,209 @@
+import io
+from bisect import bisect_left
+from itertools import accumulate
+
+import docx2txt
+from langchain.text_splitter import TextSplitter
+from langchain_core.documents import Document
+
+from helper.blob_store import get_blob_path, open_blob
+from helper.clauses import split_clauses
+from helper.database import fetch_all, transaction
+from helper.extraction import extract_pdf_pages
+from helper.file_types import TYPE_DOCX, TYPE_PDF, TYPE_TXT
+from helper.llm import count_tokens, count_tokens_batch, get_encoding, get_token_byte_lengths
+from helper.tracing import span
+
+# Longest clause embedded whole; longer ones are cut into parts of this size
+CLAUSE_MAX_TOKENS = 500
+# Preferred places to end a chunk, strongest first
+BREAK_SEPARATORS = [b"\n\n", b"\n", b" "]
+
+
+class TokenOffsetTextSplitter(TextSplitter):
+  """
+  Split text into windows of `chunk_size` tokens with `chunk_overlap` tokens
+  of overlap. Each text is tokenised once and chunks are cut on token
+  offsets, preferring paragraph, line and then word boundaries in the
+  second half of each window.
+  """
+
+  def split_text(self, text):
+    tokens = get_encoding().encode(text)
+    text = text.encode("utf-8")
+    total = len(tokens)
+    # Byte offset of every token boundary, from the start to the end of text
+    offsets = list(accumulate(map(get_token_byte_lengths().__getitem__, tokens), initial=0))
+
+    chunks = []
+    start = 0
+    while start < total:
+      end = min(start + self._chunk_size, total)
+      if end < total:
+        end = find_break(text, offsets, start + self._chunk_size // 2, end)
+        # A byte-level token may end inside a character, which would be lost from both chunks
+        end = to_character_boundary(text, offsets, end, start + 1)
+
+      chunk = text[offsets[start]:offsets[end]].decode("utf-8", errors="ignore")
+      if self._strip_whitespace:
+        chunk = chunk.strip()
+      if chunk:
+        chunks.append(chunk)
+
+      if end >= total:
+        break
+      overlap_start = find_overlap_start(text, offsets, max(end - self._chunk_overlap, start + 1), end)
+      start = to_character_boundary(text, offsets, overlap_start, start + 1)
+
+    return chunks
+
+    # End of split_text()
+
+
+def to_boundary(offsets, position):
+  """Return the first token boundary at or after a byte position."""
+
+  return bisect_left(offsets, position)
+
+
+def to_character_boundary(text, offsets, position, lowest):
+  """
+  Move a token boundary back, but not below `lowest`, until it is not
+  inside a UTF-8 character; failing that, move it forward.
+  """
+
+  def inside_character(position):
+    # Continuation bytes look like 10xxxxxx
+    return position < len(offsets) - 1 and text[offsets[position]] & 0xC0 == 0x80
+
+  boundary = position
+  while boundary > lowest and inside_character(boundary):
+    boundary -= 1
+  if not inside_character(boundary):
+    return boundary
+
+  while inside_character(position):
+    position += 1
+  return position
+
+
+def find_break(text, offsets, lowest, end):
+  """Return the token boundary in [lowest, end] to end a chunk at."""
+
+  for separator in BREAK_SEPARATORS:
+    position = text.rfind(separator, offsets[lowest], offsets[end])
+    if position >= 0:
+      return max(lowest, min(end, to_boundary(offsets, position + len(separator))))
+  return end
+
+
+def find_overlap_start(text, offsets, start, end):
+  """Move the start of an overlap forward to the next word boundary."""
+
+  positions = [text.find(separator, offsets[start], offsets[end]) for separator in BREAK_SEPARATORS]
+  positions = [position for position in positions if position >= 0]
+  if not positions:
+    return start
+  return min(end, to_boundary(offsets, min(positions)))
+
+
+def parse_pages(file_type, data):
+  """
+  Extract the text of an in-memory .docx or .txt file as a list of pages.
+  Return None if the file type is not recognised.
+  """
+
+  if file_type == TYPE_DOCX:
+    # docx has no pages; keep it as a single one
+    return [docx2txt.process(io.BytesIO(data))]
+  elif file_type == TYPE_TXT:
+    return [bytes(data).decode("utf-8", errors="replace")]
+
+  # Unrecognised type
+  return None
+
+  # End of parse_pages()
+
+
+def get_pages(file_type, blob_hash):
+  """
+  Return the pages of a stored file, parsing it only the first time its
+  content is seen; the text is kept per (content hash, page). Return None
+  if the file type is not recognised.
+  """
+
+  data = fetch_all("SELECT text FROM ParsedText WHERE blob_hash = ? ORDER BY page ASC", [blob_hash])
+  if data:
+    return [row[0] for row in data]
+
+  with span("parse"):
+    if file_type == TYPE_PDF:
+      # Read from the stored file by the configured engine, in parallel for large documents
+      pages = extract_pdf_pages(get_blob_path(blob_hash))
+    else:
+      with open_blob(blob_hash) as blob:
+        pages = parse_pages(file_type, blob)
+  if pages is None:
+    return None
+
+  with transaction() as conn:
+    conn.cursor().executemany(
+        "INSERT OR REPLACE INTO ParsedText (blob_hash, page, text) VALUES (?, ?, ?)",
+        [(blob_hash, page, text) for page, text in enumerate(pages)],
+    )
+
+  return pages
+
+  # End of get_pages()
+
+
+def get_clauses_of(file_type, blob_hash):
+  """
+  Return the clauses of a stored file, see `split_clauses`.
+  Return None if the file type is not recognised.
+  """
+
+  pages = get_pages(file_type, blob_hash)
+  if pages is None:
+    return None
+
+  with span("split"):
+    return split_clauses(pages)
+
+
+def to_documents(file_name, clauses):
+  """
+  Turn clauses into documents to embed, one per clause, with its section
+  path in the metadata. A clause over CLAUSE_MAX_TOKENS tokens is cut into
+  parts that keep its position in the "clause" metadata.
+  """
+
+  text_splitter = TokenOffsetTextSplitter(
+      chunk_size=CLAUSE_MAX_TOKENS,
+      chunk_overlap=0,
+      length_function=count_tokens,
+  )
+
+  documents = []
+  with span("split"):
+    token_counts = count_tokens_batch([clause["text"] for clause in clauses])
+    for position, (clause, tokens) in enumerate(zip(clauses, token_counts)):
+      parts = [clause["text"]] if tokens <= CLAUSE_MAX_TOKENS else text_splitter.split_text(clause["text"])
+      for part in parts:
+        documents.append(Document(
+            page_content=part,
+            metadata={"source": file_name, "page": clause["page"], "section": clause["section"], "clause": position},
+        ))
+
+  return documents
+
+  # End of to_documents()
+
+
+def split_docs(file_name, file_type, blob_hash):
+  """
+  Load a stored file and split it into one document per clause.
+  Return an empty list if the file type is not recognised.
+  """
+
+  return to_documents(file_name, get_clauses_of(file_type, blob_hash) or [])
@@ -0,0 +1,115 @@
+import hashlib
+import time
+from array import array
+
+from langchain_core.embeddings import Embeddings
+
+from helper.database import transaction
+from helper.tracing import span
+
+# Keep well below SQLite's limit on host parameters per statement
+SQL_BATCH_SIZE = 500
+
+
+def normalise_text(text):
+  return " ".join(text.split())
+
+
+class CachedEmbeddings(Embeddings):
+  """
+  Embeddings wrapper that looks up each text in the EmbeddingCache table
+  before calling the underlying model. Entries are keyed on the model name
+  and a hash of the whitespace-normalised text, and the least recently used
+  ones are evicted once the table holds more than `max_entries` rows.
+  """
+
+  def __init__(self, embeddings, model_name, max_entries=100000):
+    self.embeddings = embeddings
+    self.model_name = model_name
+    self.max_entries = max_entries
+
+  def get_key(self, text):
+    content = f"{self.model_name}\0{normalise_text(text)}"
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+  def embed_documents(self, texts):
+    with span("embed") as fields:
+      keys = [self.get_key(text) for text in texts]
+      vectors = self.lookup(keys)
+
+      # Embed each distinct missing text once
+      missing = {}
+      for key, text in zip(keys, texts):
+        if key not in vectors and key not in missing:
+          missing[key] = text
+
+      # Recorded per call, so the Metrics page can show the hit rate
+      fields["cache_misses"] = sum(1 for key in keys if key in missing)
+      fields["cache_hits"] = len(keys) - fields["cache_misses"]
+
+      if missing:
+        new_vectors = self.embeddings.embed_documents(list(missing.values()))
+        new_entries = dict(zip(missing.keys(), new_vectors))
+        self.store(new_entries)
+        vectors.update(new_entries)
+
+    return [vectors[key] for key in keys]
+
+  def embed_query(self, text):
+    return self.embed_documents([text])[0]
+
+  def lookup(self, keys):
+    """Return {key: vector} for the cached keys and mark them as used."""
+
+    vectors = {}
+    distinct_keys = list(dict.fromkeys(keys))
+    now = time.time()
+
+    with transaction() as conn:
+      cursor = conn.cursor()
+      for start in range(0, len(distinct_keys), SQL_BATCH_SIZE):
+        batch = distinct_keys[start:start + SQL_BATCH_SIZE]
+        placeholders = ", ".join("?" * len(batch))
+        cursor.execute(
+            f"SELECT key, vector FROM EmbeddingCache WHERE key IN ({placeholders})",
+            batch,
+        )
+        for key, blob in cursor.fetchall():
+          vectors[key] = array("f", blob).tolist()
+
+      cursor.executemany(
+          "UPDATE EmbeddingCache SET last_used = ? WHERE key = ?",
+          [(now, key) for key in vectors],
+      )
+
+    return vectors
+
+    # End of lookup()
+
+  def store(self, entries):
+    """Insert {key: vector} and evict the least recently used rows."""
+
+    now = time.time()
+
+    with transaction() as conn:
+      cursor = conn.cursor()
+      cursor.executemany(
+          "INSERT OR REPLACE INTO EmbeddingCache (key, model, vector, last_used) VALUES (?, ?, ?, ?)",
+          [
+              (key, self.model_name, array("f", vector).tobytes(), now)
+              for key, vector in entries.items()
+          ],
+      )
+
+      cursor.execute("SELECT COUNT(*) FROM EmbeddingCache")
+      excess = cursor.fetchone()[0] - self.max_entries
+      if excess > 0:
+        cursor.execute(
+            """
+            DELETE FROM EmbeddingCache WHERE key IN (
+                SELECT key FROM EmbeddingCache ORDER BY last_used ASC LIMIT ?
+            )""",
+            [excess],
+        )
+
+    # End of store()
@@ -0,0 +1,72 @@
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from helper.utility import get_secret_value
+
+# Engine used to extract the text of PDF files, one of PDF_ENGINES
+PDF_ENGINE = get_secret_value("PDF_ENGINE") or "pymupdf"
+EXTRACTION_WORKERS = int(get_secret_value("EXTRACTION_WORKERS") or min(4, os.cpu_count() or 1))
+# Smaller documents are extracted in the calling process, as starting workers costs more
+PARALLEL_EXTRACTION_MIN_PAGES = 100
+
+
+def count_pages_pymupdf(path):
+  import pymupdf
+
+  with pymupdf.open(path) as document:
+    return document.page_count
+
+
+def extract_pages_pymupdf(path, start, stop):
+  import pymupdf
+
+  with pymupdf.open(path) as document:
+    return [document[number].get_text() for number in range(start, stop)]
+
+
+def count_pages_pypdf(path):
+  import pypdf
+
+  return len(pypdf.PdfReader(path).pages)
+
+
+def extract_pages_pypdf(path, start, stop):
+  import pypdf
+
+  pdf_reader = pypdf.PdfReader(path)
+  return [pdf_reader.pages[number].extract_text() for number in range(start, stop)]
+
+
+# Engine name: (count pages of a file, extract the text of pages [start, stop))
+PDF_ENGINES = {
+    "pymupdf": (count_pages_pymupdf, extract_pages_pymupdf),
+    "pypdf": (count_pages_pypdf, extract_pages_pypdf),
+}
+
+
+def extract_pdf_pages(path, engine=PDF_ENGINE):
+  """
+  Return the text of every page of a PDF file. Documents of at least
+  PARALLEL_EXTRACTION_MIN_PAGES pages are split into page ranges extracted
+  by EXTRACTION_WORKERS processes.
+  """
+
+  if engine not in PDF_ENGINES:
+    raise ValueError(f"Unknown PDF engine {engine}; use one of {', '.join(PDF_ENGINES)}")
+
+  count_pages, extract_pages = PDF_ENGINES[engine]
+  total = count_pages(path)
+  if total < PARALLEL_EXTRACTION_MIN_PAGES or EXTRACTION_WORKERS < 2:
+    return extract_pages(path, 0, total)
+
+  size = math.ceil(total / EXTRACTION_WORKERS)
+  starts = list(range(0, total, size))
+  stops = [min(start + size, total) for start in starts]
+  # Workers open the file themselves, so only page numbers and text are sent across
+  with ProcessPoolExecutor(max_workers=len(starts), mp_context=multiprocessing.get_context("spawn")) as executor:
+    parts = executor.map(extract_pages, [path] * len(starts), starts, stops)
+    return [text for part in parts for text in part]
+
+  # End of extract_pdf_pages()
@@ -0,0 +1,49 @@
+import os
+
+TYPE_DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+TYPE_PDF = "application/pdf"
+TYPE_TXT = "text/plain"
+
+FILE_TYPES = {".docx": TYPE_DOCX, ".pdf": TYPE_PDF, ".txt": TYPE_TXT}
+
+# Bytes read from the start of a file to recognise its type
+SNIFF_SIZE = 8192
+
+
+def sniff_type(head):
+  """
+  Return the type of a file from its first bytes, whatever its name says,
+  or None if it is not a .docx, .pdf or .txt file.
+  """
+
+  if head.startswith(b"%PDF-"):
+    return TYPE_PDF
+  # docx is a zip container
+  if head.startswith(b"PK\x03\x04"):
+    return TYPE_DOCX
+  # Other binary formats have NUL bytes early on; text is decoded leniently
+  if b"\x00" not in head:
+    return TYPE_TXT
+
+  return None
+
+
+def sniff_files(files):
+  """
+  Return the type of every readable binary file, leaving each at its start.
+  Raise ValueError naming the files that are not .docx, .pdf or .txt.
+  """
+
+  file_types = []
+  for file in files:
+    file.seek(0)
+    file_types.append(sniff_type(file.read(SNIFF_SIZE)))
+    file.seek(0)
+
+  unsupported = [os.path.basename(file.name) for file, file_type in zip(files, file_types) if file_type is None]
+  if unsupported:
+    raise ValueError(f"Not a .docx, .pdf or .txt file: {', '.join(unsupported)}")
+
+  return file_types
+
+  # End of sniff_files()
@@ -0,0 +1,193 @@
+import threading
+import time
+from collections import defaultdict
+from functools import lru_cache
+
+import chromadb
+from langchain_chroma import Chroma
+
+import helper
+from helper.clauses import delete_clauses, save_clauses
+from helper.database import execute_non_query, fetch_one
+from helper.document import get_clauses_of, to_documents
+from helper.jobs import wait_for_index_job
+from helper.tracing import span
+
+VECTOR_STORE_DIRECTORY = "./vector_store"
+COLLECTION_PREFIX = "honchun_abc_file_"
+EMBEDDING_BATCH_SIZE = 100
+# Record an index as used at most this often per process
+TOUCH_INTERVAL_IN_SECONDS = 60
+# Longest an analysis waits for the background job indexing one of its files
+INDEX_JOB_WAIT_IN_SECONDS = 600
+
+chroma_client_lock = threading.Lock()
+# When each index was last recorded as used by this process
+last_touched = {}
+# One lock per file, so its index is never built or dropped by two threads at once
+build_locks = defaultdict(threading.RLock)
+build_locks_lock = threading.Lock()
+
+
+def get_collection_name(file_id):
+  return f"{COLLECTION_PREFIX}{file_id}"
+
+
+def get_chunk_id(file_id, position):
+  return f"{file_id}-{position}"
+
+
+@lru_cache(maxsize=None)
+def create_chroma_client():
+  return chromadb.PersistentClient(path=VECTOR_STORE_DIRECTORY)
+
+
+def get_chroma_client():
+  """
+  Return the vector store client of this process. It is created once under
+  a lock, as creating it from several threads at once fails.
+  """
+
+  with chroma_client_lock:
+    return create_chroma_client()
+
+
+def open_file_index(file_id):
+  """Open the persistent collection of a file; it may be empty."""
+
+  return Chroma(
+      collection_name=get_collection_name(file_id),
+      embedding_function=helper.llm.embeddings_model,
+      client=get_chroma_client(),
+  )
+
+
+def get_build_lock(file_id):
+  with build_locks_lock:
+    return build_locks[file_id]
+
+
+def touch_file_index(file_id):
+  """Record that a file's index was used, so it is evicted last."""
+
+  now = time.time()
+  if now - last_touched.get(file_id, 0) < TOUCH_INTERVAL_IN_SECONDS:
+    return
+  last_touched[file_id] = now
+
+  execute_non_query(
+      """
+      INSERT INTO FileIndexes (file_id, last_used)
+        SELECT file_id, ? FROM Files WHERE file_id = ?
+      ON CONFLICT (file_id) DO UPDATE SET last_used = excluded.last_used""",
+      [now, file_id],
+  )
+
+  # End of touch_file_index()
+
+
+def build_file_index(file_id, file_name, file_type, blob_hash, progress=None):
+  """
+  Split a file into clauses and embed them once into its own persistent
+  collection, calling `progress(fraction)` as batches of chunks are
+  embedded. The old clauses are dropped first and the new ones stored once
+  the index is complete, so clauses are never read with a partial index.
+  Return the vector db, or None if the file cannot be loaded.
+  """
+
+  report = progress or (lambda fraction: None)
+
+  clauses = get_clauses_of(file_type, blob_hash)
+  if not clauses:
+    return None
+  splitted_documents = to_documents(file_name, clauses)
+  report(0.1)
+
+  # Start from a clean collection in case a previous build was interrupted
+  delete_clauses(file_id)
+  vector_db = open_file_index(file_id)
+  vector_db.reset_collection()
+
+  # Record each chunk's id, position and content version so retrieved
+  # chunks can be traced back, and cached answers expire when a file changes
+  for n, document in enumerate(splitted_documents):
+    document.metadata["chunk_id"] = get_chunk_id(file_id, n)
+    document.metadata["chunk"] = n
+    document.metadata["blob_hash"] = blob_hash
+
+  total = len(splitted_documents)
+  for start in range(0, total, EMBEDDING_BATCH_SIZE):
+    end = min(start + EMBEDDING_BATCH_SIZE, total)
+    with span("index_write"):
+      vector_db.add_documents(
+          splitted_documents[start:end],
+          ids=[get_chunk_id(file_id, n) for n in range(start, end)],
+      )
+    report(0.1 + 0.9 * end / total)
+
+  save_clauses(file_id, blob_hash, clauses)
+  touch_file_index(file_id)
+  return vector_db
+
+  # End of build_file_index()
+
+
+def is_index_ready(vector_db, file_id, blob_hash):
+  """
+  True if both the collection and the stored clauses of a file were made
+  from its current content `blob_hash`. A replaced file keeps its id, so
+  its old index is still there until the new one is built.
+  """
+
+  data = vector_db._collection.get(limit=1, include=["metadatas"])
+  if not data["metadatas"] or data["metadatas"][0].get("blob_hash") != blob_hash:
+    return False
+  return fetch_one("SELECT 1 FROM Clauses WHERE file_id = ? AND blob_hash = ?", [file_id, blob_hash]) is not None
+
+
+def get_file_index(file_id):
+  """
+  Return the vector db of a file, building it on first use for files
+  uploaded before indexes were created at upload time, and rebuilding
+  indexes made from older content or before files were split into
+  clauses. A file still queued or being indexed in the background is
+  waited for rather than read half-built or built alongside its job.
+  Return None if the file does not exist, cannot be loaded or is still
+  being indexed after INDEX_JOB_WAIT_IN_SECONDS.
+  """
+
+  if not wait_for_index_job(file_id, INDEX_JOB_WAIT_IN_SECONDS):
+    return None
+
+  data = fetch_one(
+      """
+                  SELECT file_name, type, blob_hash
+                  FROM Files
+                  WHERE file_id = ?""",
+      [file_id],
+  )
+  if not data:
+    return None
+
+  file_name, file_type, blob_hash = data
+  vector_db = open_file_index(file_id)
+  if is_index_ready(vector_db, file_id, blob_hash):
+    touch_file_index(file_id)
+    return vector_db
+
+  with get_build_lock(file_id):
+    # The job or another analysis may have built it meanwhile
+    vector_db = open_file_index(file_id)
+    if is_index_ready(vector_db, file_id, blob_hash):
+      touch_file_index(file_id)
+      return vector_db
+
+    return build_file_index(file_id, file_name, file_type, blob_hash)
+
+  # End of get_file_index()
+
+
+def delete_file_index(file_id):
+  with get_build_lock(file_id):
+    open_file_index(file_id).delete_collection()
+  last_touched.pop(file_id, None)
@@ -0,0 +1,230 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import pandas as pd
+import streamlit as st
+
+from helper.database import execute_non_query, fetch_all, fetch_one, transaction
+from helper.tracing import start_run
+from helper.utility import get_secret_value
+
+INGEST_WORKERS = int(get_secret_value("INGEST_WORKERS") or 2)
+POLL_INTERVAL_IN_SECONDS = 1
+# A running job that has not reported progress for this long was left behind by a stopped server
+JOB_STALE_AFTER_IN_SECONDS = 600
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+def enqueue_index_job(file_id):
+  """Queue a file to be parsed, split and embedded in the background."""
+
+  return execute_non_query("INSERT INTO Jobs (file_id, status) VALUES (?, ?)", [file_id, JOB_QUEUED])
+
+
+def update_job(job_id, status=None, progress=None, message=None):
+  execute_non_query(
+      """
+      UPDATE Jobs
+      SET status = COALESCE(?, status),
+          progress = COALESCE(?, progress),
+          message = COALESCE(?, message),
+          modification_date = DATETIME(CURRENT_TIMESTAMP, '+8 hours')
+      WHERE job_id = ?""",
+      [status, progress, message, job_id],
+  )
+
+
+def claim_next_job():
+  """Atomically mark the oldest queued job as running and return it."""
+
+  with transaction():
+    return fetch_one(
+        """
+        UPDATE Jobs
+        SET status = ?, modification_date = DATETIME(CURRENT_TIMESTAMP, '+8 hours')
+        WHERE job_id = (SELECT job_id FROM Jobs WHERE status = ? ORDER BY job_id LIMIT 1)
+        RETURNING job_id, file_id""",
+        [JOB_RUNNING, JOB_QUEUED],
+    )
+
+
+def claim_file_job(file_id):
+  """
+  Atomically mark the latest index job of a file as running if it is
+  queued, or has been running without progress for
+  JOB_STALE_AFTER_IN_SECONDS, and return its id; otherwise return None.
+  """
+
+  with transaction():
+    data = fetch_one(
+        """
+        UPDATE Jobs
+        SET status = ?, modification_date = DATETIME(CURRENT_TIMESTAMP, '+8 hours')
+        WHERE job_id = (SELECT MAX(job_id) FROM Jobs WHERE file_id = ?)
+          AND (status = ? OR (status = ? AND modification_date < DATETIME(CURRENT_TIMESTAMP, '+8 hours', ?)))
+        RETURNING job_id""",
+        [JOB_RUNNING, file_id, JOB_QUEUED, JOB_RUNNING, f"-{JOB_STALE_AFTER_IN_SECONDS} seconds"],
+    )
+  return data[0] if data else None
+
+
+def get_indexing_files(file_ids):
+  """Return the ids of the files whose latest index job is queued or running."""
+
+  if not file_ids:
+    return []
+  data = fetch_all(
+      f"""
+      SELECT t1.file_id
+      FROM Jobs t1
+      WHERE t1.file_id IN ({", ".join("?" * len(file_ids))})
+        AND t1.job_id = (SELECT MAX(job_id) FROM Jobs WHERE file_id = t1.file_id)
+        AND t1.status IN (?, ?)""",
+      [*file_ids, JOB_QUEUED, JOB_RUNNING],
+  )
+  return [row[0] for row in data]
+
+
+def wait_for_index_job(file_id, timeout):
+  """
+  Wait while the latest index job of a file is queued or running. Return
+  False if it is still pending after `timeout` seconds.
+  """
+
+  deadline = time.monotonic() + timeout
+  while get_indexing_files([file_id]):
+    if time.monotonic() >= deadline:
+      return False
+    time.sleep(POLL_INTERVAL_IN_SECONDS)
+  return True
+
+
+def run_index_job(job_id, file_id):
+  """
+  Build the index of one file. Runs in a worker thread of the server
+  process, as the vector store must only be written through one client;
+  the file's build lock keeps analyses from building it at the same time.
+  """
+
+  # Imported here so that the page process does not pay for it at startup
+  from helper.index import build_file_index, delete_file_index, get_build_lock
+
+  try:
+    data = fetch_one("SELECT file_name, type, blob_hash, repository_id FROM Files WHERE file_id = ?", [file_id])
+    if not data:
+      update_job(job_id, status=JOB_FAILED, message="File no longer exists")
+      return
+
+    file_name, file_type, blob_hash, repository_id = data
+    with get_build_lock(file_id), start_run("index", repository_id):
+      vector_db = build_file_index(
+          file_id, file_name, file_type, blob_hash,
+          progress=lambda fraction: update_job(job_id, progress=fraction),
+      )
+      if vector_db is None:
+        update_job(job_id, status=JOB_FAILED, message="Unrecognised file type")
+        return
+
+      # The repository may have been deleted while the file was being indexed
+      if not fetch_one("SELECT 1 FROM Files WHERE file_id = ?", [file_id]):
+        delete_file_index(file_id)
+
+    update_job(job_id, status=JOB_DONE, progress=1.0)
+  except Exception as e:
+    update_job(job_id, status=JOB_FAILED, message=str(e))
+
+  # End of run_index_job()
+
+
+def dispatch_jobs(executor):
+  """Feed queued jobs to the worker threads, one per free worker."""
+
+  slots = threading.Semaphore(INGEST_WORKERS)
+
+  def on_done(job_id, future):
+    slots.release()
+    # run_index_job records its own errors, so this one escaped it
+    if not future.cancelled() and future.exception() is not None:
+      update_job(job_id, status=JOB_FAILED, message=str(future.exception()))
+
+  while True:
+    slots.acquire()
+    try:
+      job = claim_next_job()
+    except Exception:
+      # e.g. database is locked; try again on the next poll
+      job = None
+
+    if job is None:
+      slots.release()
+      time.sleep(POLL_INTERVAL_IN_SECONDS)
+      continue
+
+    future = executor.submit(run_index_job, job[0], job[1])
+    future.add_done_callback(partial(on_done, job[0]))
+
+  # End of dispatch_jobs()
+
+
+@st.cache_resource
+def start_ingestion_workers():
+  """
+  Start the workers once per server process. Jobs left running by a
+  previous server are queued again, so queued work survives restarts.
+  Parsing large PDFs still uses several processes, see `extract_pdf_pages`.
+  """
+
+  execute_non_query("UPDATE Jobs SET status = ? WHERE status = ?", [JOB_QUEUED, JOB_RUNNING])
+
+  executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+  threading.Thread(target=dispatch_jobs, args=[executor], daemon=True).start()
+  return executor
+
+  # End of start_ingestion_workers()
+
+
+def get_files_status(repository_id):
+  """Return the latest job of every file in a repository as a DataFrame."""
+
+  data = fetch_all(
+      """
+      SELECT t1.file_name, COALESCE(t2.status, ?), COALESCE(t2.progress, 1) * 100, t2.message
+      FROM Files t1
+      LEFT JOIN Jobs t2 ON t2.job_id = (SELECT MAX(job_id) FROM Jobs WHERE file_id = t1.file_id)
+      WHERE t1.repository_id = ?
+      ORDER BY t1.file_name ASC""",
+      [JOB_DONE, repository_id],
+  )
+  return pd.DataFrame(data, columns=["file_name", "status", "progress", "message"])
+
+
+def show_files_status(repository_id):
+  """Show per-file ingestion status, refreshing while jobs are pending."""
+
+  def render():
+    st.dataframe(
+        get_files_status(repository_id),
+        column_config={
+            "file_name": st.column_config.Column("File", width="large"),
+            "status": st.column_config.Column("Status", width="small"),
+            "progress": st.column_config.ProgressColumn("Progress", min_value=0, max_value=100, format="%.0f%%"),
+            "message": st.column_config.Column("Message", width="medium"),
+        },
+        hide_index=True,
+    )
+
+  pending = fetch_one(
+      """
+      SELECT 1 FROM Jobs t1 JOIN Files t2 ON t2.file_id = t1.file_id
+      WHERE t2.repository_id = ? AND t1.status IN (?, ?)""",
+      [repository_id, JOB_QUEUED, JOB_RUNNING],
+  )
+  st.fragment(render, run_every=POLL_INTERVAL_IN_SECONDS * 2 if pending else None)()
+
+  # End of show_files_status()
@@ -1,13 +1,114 @@
-import tiktoken
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 
 from helper.utility import get_secret_value
 
+TOKEN_COUNT_CACHE_SIZE = 65536
+
 model_name = get_secret_value("OPENAI_MODEL_NAME")
-embeddings_model = OpenAIEmbeddings(model=get_secret_value("EMBEDDINGS_MODEL"))
-llm = ChatOpenAI(model=model_name, temperature=0, seed=42)
+embeddings_model_name = get_secret_value("EMBEDDINGS_MODEL")
+
+# Guards the one-time creation of the model clients below
+client_lock = threading.Lock()
+
+
+def create_embeddings_model():
+  # Imported here, like the chat model, so that importing this module is cheap
+  from langchain_openai import OpenAIEmbeddings
+
+  from helper.embedding_cache import CachedEmbeddings
+
+  return CachedEmbeddings(
+      OpenAIEmbeddings(model=embeddings_model_name),
+      model_name=embeddings_model_name,
+      max_entries=int(get_secret_value("EMBEDDINGS_CACHE_MAX_ENTRIES") or 100000),
+  )
+
+
+def create_llm():
+  from langchain_openai import ChatOpenAI
+
+  # stream_usage reports token usage on streamed responses too
+  return ChatOpenAI(model=model_name, temperature=0, seed=42, stream_usage=True)
+
+
+CLIENT_FACTORIES = {"embeddings_model": create_embeddings_model, "llm": create_llm}
+
+
+def __getattr__(name):
+  """
+  Create `embeddings_model` and `llm` on first access instead of at import,
+  once per process. Assigning either attribute replaces the client.
+  """
+
+  factory = CLIENT_FACTORIES.get(name)
+  if factory is None:
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+  with client_lock:
+    if name not in globals():
+      globals()[name] = factory()
+  return globals()[name]
+
+
+# Token lengths of recently counted fragments, most recent last
+token_count_cache = OrderedDict()
+token_count_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_encoding():
+  """Build the tokenizer of the chat model once per process."""
+
+  import tiktoken
+
+  try:
+    return tiktoken.encoding_for_model(model_name)
+  except KeyError:
+    # Model not known to this tiktoken release
+    return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=None)
+def get_token_byte_lengths():
+  """Byte length of every token id, so offsets can be summed without decoding."""
+
+  encoding = get_encoding()
+  lengths = []
+  for token in range(encoding.n_vocab):
+    try:
+      lengths.append(len(encoding.decode_single_token_bytes(token)))
+    except KeyError:
+      # Unused id between the ordinary and special tokens
+      lengths.append(0)
+  return lengths
+
+
+def remember_token_count(text, length):
+  with token_count_lock:
+    token_count_cache[text] = length
+    if len(token_count_cache) > TOKEN_COUNT_CACHE_SIZE:
+      token_count_cache.popitem(last=False)
 
 
 def count_tokens(text):
-  encoding = tiktoken.encoding_for_model(model_name)
-  return len(encoding.encode(text))
+  with token_count_lock:
+    if text in token_count_cache:
+      token_count_cache.move_to_end(text)
+      return token_count_cache[text]
+
+  length = len(get_encoding().encode(text))
+  remember_token_count(text, length)
+  return length
+
+
+def count_tokens_batch(texts):
+  """Count tokens of many texts, encoding the uncounted ones in one batch."""
+
+  uncounted = [text for text in dict.fromkeys(texts) if text not in token_count_cache]
+  if uncounted:
+    for text, tokens in zip(uncounted, get_encoding().encode_batch(uncounted)):
+      remember_token_count(text, len(tokens))
+
+  return [count_tokens(text) for text in texts]
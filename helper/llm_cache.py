@@ -0,0 +1,196 @@
+import hashlib
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import helper
+from helper.database import execute_non_query, fetch_one, transaction
+from helper.tracing import span
+from helper.utility import get_secret_value
+
+LLM_CACHE_TTL_IN_HOURS = float(get_secret_value("LLM_CACHE_TTL_IN_HOURS") or 168)
+LLM_CACHE_MAX_ENTRIES = int(get_secret_value("LLM_CACHE_MAX_ENTRIES") or 10000)
+# Prompts of one batch streamed at the same time
+STREAM_MAX_CONCURRENT_PROMPTS = 8
+
+
+def get_cache_key(*parts):
+  """Hash the model name and the given parts, e.g. template, chunk ids, query."""
+
+  content = json.dumps([helper.llm.model_name, *parts], ensure_ascii=False)
+  return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def get_cached_response(key):
+  """Return a cached response that has not expired, or None."""
+
+  now = time.time()
+  data = fetch_one(
+      "SELECT response FROM LLMCache WHERE key = ? AND creation_time > ?",
+      [key, now - LLM_CACHE_TTL_IN_HOURS * 3600],
+  )
+  if data is None:
+    return None
+
+  execute_non_query("UPDATE LLMCache SET last_used = ? WHERE key = ?", [now, key])
+  return data[0]
+
+
+def store_response(key, response):
+  """Cache a response, dropping expired and least recently used entries."""
+
+  now = time.time()
+  with transaction():
+    execute_non_query(
+        "INSERT OR REPLACE INTO LLMCache (key, model, response, creation_time, last_used) VALUES (?, ?, ?, ?, ?)",
+        [key, helper.llm.model_name, response, now, now],
+    )
+    execute_non_query("DELETE FROM LLMCache WHERE creation_time <= ?", [now - LLM_CACHE_TTL_IN_HOURS * 3600])
+    execute_non_query(
+        """
+        DELETE FROM LLMCache WHERE key IN (
+            SELECT key FROM LLMCache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+        )""",
+        [LLM_CACHE_MAX_ENTRIES],
+    )
+
+  # End of store_response()
+
+
+def add_usage(fields, message):
+  """Add the token usage of an LLM response to the fields of a span."""
+
+  usage = getattr(message, "usage_metadata", None) or {}
+  fields["prompt_tokens"] = fields.get("prompt_tokens", 0) + usage.get("input_tokens", 0)
+  fields["completion_tokens"] = fields.get("completion_tokens", 0) + usage.get("output_tokens", 0)
+
+
+def invoke_cached(prompt, key_parts=None, use_cache=True, on_token=None):
+  """
+  Return (response text, True if it came from the cache) for a prompt.
+  The key defaults to the prompt itself; pass `key_parts` to key on the
+  template, retrieved chunk ids and query instead. With `on_token`, the
+  response is streamed to it piece by piece as the model produces it.
+  """
+
+  emit = on_token or (lambda text: None)
+
+  key = get_cache_key(*(key_parts or [prompt]))
+  if use_cache:
+    response = get_cached_response(key)
+    if response is not None:
+      emit(response)
+      return response, True
+
+  with span("llm") as fields:
+    if on_token is None:
+      message = helper.llm.llm.invoke(prompt)
+    else:
+      message = None
+      for chunk in helper.llm.llm.stream(prompt):
+        emit(chunk.content)
+        message = chunk if message is None else message + chunk
+    add_usage(fields, message)
+  response = message.content if message is not None else ""
+
+  store_response(key, response)
+  return response, False
+
+  # End of invoke_cached()
+
+
+def stream_batch(prompts, emit):
+  """
+  Stream several prompts concurrently and return their final messages.
+  Text is passed to `emit` in the calling thread, one response at a time
+  in prompt order: the earliest unfinished response as it is generated,
+  later ones as soon as those before them are complete.
+  """
+
+  # (prompt number, text), with None as text once a prompt is done
+  tokens = queue.Queue()
+  stopped = threading.Event()
+
+  def stream(n):
+    message = None
+    try:
+      for chunk in helper.llm.llm.stream(prompts[n]):
+        if stopped.is_set():
+          break
+        tokens.put((n, chunk.content))
+        message = chunk if message is None else message + chunk
+    finally:
+      tokens.put((n, None))
+    return message
+
+  held = [[] for _ in prompts]
+  finished = [False] * len(prompts)
+  current = 0
+  executor = ThreadPoolExecutor(max_workers=min(len(prompts), STREAM_MAX_CONCURRENT_PROMPTS))
+  try:
+    futures = [executor.submit(stream, n) for n in range(len(prompts))]
+    for _ in range(len(prompts)):
+      while True:
+        n, text = tokens.get()
+        if text is None:
+          finished[n] = True
+          break
+        held[n].append(text)
+        if n == current:
+          emit("".join(held[n]))
+          held[n] = []
+
+      while current < len(prompts) and finished[current]:
+        emit("".join(held[current]) + "\n\n")
+        held[current] = []
+        current += 1
+      if current < len(prompts) and held[current]:
+        emit("".join(held[current]))
+        held[current] = []
+  finally:
+    # Also reached when `emit` raises, e.g. as the page was stopped
+    stopped.set()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+  return [future.result() for future in futures]
+
+  # End of stream_batch()
+
+
+def batch_cached(prompts, use_cache=True, on_token=None):
+  """
+  Return (response texts, True if all came from the cache). Only prompts
+  missing from the cache are sent. With `on_token`, they are streamed
+  concurrently and passed to it piece by piece, see `stream_batch`;
+  without, they are sent as one batch.
+  """
+
+  emit = on_token or (lambda text: None)
+
+  keys = [get_cache_key(prompt) for prompt in prompts]
+  responses = [get_cached_response(key) if use_cache else None for key in keys]
+  for response in responses:
+    if response is not None:
+      emit(response + "\n\n")
+
+  missing = [n for n, response in enumerate(responses) if response is None]
+  if missing and on_token is None:
+    with span("llm") as fields:
+      for index, result in helper.llm.llm.batch_as_completed([prompts[n] for n in missing]):
+        n = missing[index]
+        responses[n] = result.content
+        store_response(keys[n], result.content)
+        add_usage(fields, result)
+  elif missing:
+    with span("llm") as fields:
+      messages = stream_batch([prompts[n] for n in missing], emit)
+      for n, message in zip(missing, messages):
+        responses[n] = message.content if message is not None else ""
+        store_response(keys[n], responses[n])
+        add_usage(fields, message)
+
+  return responses, not missing
+
+  # End of batch_cached()
@@ -0,0 +1,51 @@
+import threading
+
+import streamlit as st
+
+from helper.blob_store import purge_unreferenced_blobs, sweep_orphaned_blob_files
+from helper.database import vacuum_database
+from helper.vector_store_gc import collect_vector_store_garbage
+
+MAINTENANCE_INTERVAL_IN_SECONDS = 300
+
+# Set to run maintenance now instead of at the next interval
+maintenance_requested = threading.Event()
+
+
+def run_maintenance():
+  """
+  Reclaim storage left behind by deleted files: their vector indexes, the
+  stored content nothing refers to any more, blobs of failed uploads and
+  free database pages.
+  """
+
+  collect_vector_store_garbage()
+  purge_unreferenced_blobs()
+  sweep_orphaned_blob_files()
+  vacuum_database()
+
+
+def run_maintenance_loop():
+  while True:
+    maintenance_requested.wait(MAINTENANCE_INTERVAL_IN_SECONDS)
+    maintenance_requested.clear()
+    try:
+      run_maintenance()
+    except Exception:
+      # e.g. database is locked; try again on the next round
+      pass
+
+
+def request_maintenance():
+  """Ask the background maintenance to run soon, e.g. after a deletion."""
+
+  maintenance_requested.set()
+
+
+@st.cache_resource
+def start_maintenance():
+  """Start background storage maintenance once per server process."""
+
+  thread = threading.Thread(target=run_maintenance_loop, daemon=True)
+  thread.start()
+  return thread
@@ -0,0 +1,133 @@
+import time
+
+import pandas as pd
+import streamlit as st
+import streamlit_antd_components as sac
+
+from helper.database import fetch_all
+from helper.utility import get_secret_value
+
+# USD per million tokens, gpt-4o-mini by default
+PROMPT_TOKEN_PRICE = float(get_secret_value("PROMPT_TOKEN_PRICE_PER_MILLION") or 0.15)
+COMPLETION_TOKEN_PRICE = float(get_secret_value("COMPLETION_TOKEN_PRICE_PER_MILLION") or 0.6)
+SLOWEST_RUNS = 20
+
+PERIODS_IN_HOURS = {"Last 24 hours": 24, "Last 7 days": 24 * 7, "Last 30 days": 24 * 30}
+
+
+def get_stage_latency(since):
+  """
+  Return p50/p95 latency, call count and cache hit rate of every stage
+  since a time. Only stages that record cache hits have a hit rate.
+  """
+
+  data = fetch_all("SELECT stage, duration, cache_hits, cache_misses FROM Metrics WHERE creation_time > ?", [since])
+  df = pd.DataFrame(data, columns=["stage", "duration", "cache_hits", "cache_misses"])
+  latency = df.groupby("stage").agg(
+      count=("duration", "count"),
+      p50=("duration", lambda durations: durations.quantile(0.5)),
+      p95=("duration", lambda durations: durations.quantile(0.95)),
+      total=("duration", "sum"),
+      cache_hits=("cache_hits", "sum"),
+      cache_misses=("cache_misses", "sum"),
+  )
+  lookups = latency["cache_hits"] + latency["cache_misses"]
+  latency["hit_rate"] = (latency["cache_hits"] / lookups.where(lookups > 0)) * 100
+  latency = latency.drop(columns=["cache_hits", "cache_misses"])
+  return latency.reset_index().sort_values("total", ascending=False)
+
+
+def get_repository_cost(since):
+  """Return runs, tokens and estimated cost of every repository since a time."""
+
+  data = fetch_all(
+      """
+      SELECT COALESCE(t2.name, t1.repository_id, '-'), COUNT(DISTINCT t1.run_id),
+             COALESCE(SUM(t1.prompt_tokens), 0), COALESCE(SUM(t1.completion_tokens), 0)
+      FROM Metrics t1
+      LEFT JOIN Repository t2 ON t2.repository_id = t1.repository_id
+      WHERE t1.creation_time > ? AND t1.stage = 'llm'
+      GROUP BY t1.repository_id""",
+      [since],
+  )
+  df = pd.DataFrame(data, columns=["name", "runs", "prompt_tokens", "completion_tokens"])
+  df["cost"] = (df["prompt_tokens"] * PROMPT_TOKEN_PRICE + df["completion_tokens"] * COMPLETION_TOKEN_PRICE) / 1e6
+  return df.sort_values("cost", ascending=False)
+
+
+def get_slowest_runs(since):
+  data = fetch_all(
+      """
+      SELECT t1.run_name, COALESCE(t2.name, t1.repository_id, '-'), t1.duration,
+             DATETIME(t1.creation_time, 'unixepoch', '+8 hours'),
+             (SELECT COALESCE(SUM(prompt_tokens), 0) + COALESCE(SUM(completion_tokens), 0)
+              FROM Metrics WHERE run_id = t1.run_id AND stage = 'llm')
+      FROM Metrics t1
+      LEFT JOIN Repository t2 ON t2.repository_id = t1.repository_id
+      WHERE t1.creation_time > ? AND t1.stage = 'run'
+      ORDER BY t1.duration DESC
+      LIMIT ?""",
+      [since, SLOWEST_RUNS],
+  )
+  return pd.DataFrame(data, columns=["run_name", "name", "duration", "creation_date", "tokens"])
+
+
+def show_metrics():
+  """Admin view of stage latency, token usage and cost, and the slowest runs."""
+
+  period = sac.segmented(items=list(PERIODS_IN_HOURS), align="start", size="sm", key="key_metrics_period")
+  since = time.time() - PERIODS_IN_HOURS[period] * 3600
+
+  latency = get_stage_latency(since)
+  if latency.empty:
+    sac.alert(
+        label="No metrics yet.",
+        description="Metrics are recorded as files are indexed and analysed.",
+        color="info",
+        banner=False,
+        icon=True,
+        closable=False,
+    )
+    return
+
+  st.subheader("Latency per stage")
+  st.dataframe(
+      latency,
+      column_config={
+          "stage": st.column_config.Column("Stage", width="medium"),
+          "count": st.column_config.NumberColumn("Calls"),
+          "p50": st.column_config.NumberColumn("p50 (s)", format="%.3f"),
+          "p95": st.column_config.NumberColumn("p95 (s)", format="%.3f"),
+          "total": st.column_config.NumberColumn("Total (s)", format="%.1f"),
+          "hit_rate": st.column_config.NumberColumn("Cache hits", format="%.0f%%"),
+      },
+      hide_index=True,
+  )
+
+  st.subheader("Tokens and estimated cost per repository")
+  st.dataframe(
+      get_repository_cost(since),
+      column_config={
+          "name": st.column_config.Column("Repository", width="medium"),
+          "runs": st.column_config.NumberColumn("Runs"),
+          "prompt_tokens": st.column_config.NumberColumn("Prompt tokens"),
+          "completion_tokens": st.column_config.NumberColumn("Completion tokens"),
+          "cost": st.column_config.NumberColumn("Cost (USD)", format="$%.4f"),
+      },
+      hide_index=True,
+  )
+
+  st.subheader("Slowest runs")
+  st.dataframe(
+      get_slowest_runs(since),
+      column_config={
+          "run_name": st.column_config.Column("Action", width="small"),
+          "name": st.column_config.Column("Repository", width="medium"),
+          "duration": st.column_config.NumberColumn("Duration (s)", format="%.1f"),
+          "creation_date": st.column_config.DatetimeColumn("Finished", format="D MMM YYYY, h:mm a"),
+          "tokens": st.column_config.NumberColumn("Tokens"),
+      },
+      hide_index=True,
+  )
+
+  # End of show_metrics()
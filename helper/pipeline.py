@@ -0,0 +1,146 @@
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from helper.blob_store import commit_blob, staged_blobs
+from helper.clause_check import check_clauses, embed_clauses
+from helper.conflicts import find_conflicts, find_cross_file_conflicts, get_table_rows
+from helper.database import execute_non_query, fetch_all, transaction
+from helper.file_types import FILE_TYPES, sniff_files
+from helper.jobs import claim_file_job, run_index_job
+from helper.tracing import in_current_run
+
+MODE_ANALYSE = "analyse"
+MODE_COMPARE = "compare"
+MODE_CHECK = "check"
+
+# Columns of the conflict rows returned for each mode
+RESULT_COLUMNS = {
+    MODE_ANALYSE: ["source_1", "source_2", "explanation"],
+    MODE_COMPARE: ["source_1", "source_2", "explanation"],
+    MODE_CHECK: ["clause", "conflict", "explanation"],
+}
+
+
+def get_repository_files(repository_id):
+  """Return {file_id: file_name} for a repository, by file name."""
+
+  data = fetch_all(
+      "SELECT file_id, file_name FROM Files WHERE repository_id = ? ORDER BY file_name ASC",
+      [repository_id],
+  )
+  return {row[0]: row[1] for row in data}
+
+
+def import_directory(path, repository_name=None):
+  """
+  Store the .docx, .pdf and .txt files of a directory as a new repository
+  and return its id. Indexes are built on first analysis. Raise ValueError,
+  storing nothing, if a file's content is not of a supported type.
+  """
+
+  file_names = sorted(
+      name for name in os.listdir(path)
+      if os.path.isfile(os.path.join(path, name)) and os.path.splitext(name)[1].lower() in FILE_TYPES
+  )
+  if not file_names:
+    raise ValueError(f"No .docx, .pdf or .txt files in {path}")
+
+  files = [open(os.path.join(path, file_name), "rb") for file_name in file_names]
+  try:
+    file_types = sniff_files(files)
+
+    repository_id = str(uuid.uuid4())
+    # Copied and hashed before taking the write lock other writers wait on
+    with staged_blobs(files) as blobs, transaction():
+      execute_non_query(
+          "INSERT INTO Repository (repository_id, name) VALUES (?, ?)",
+          [repository_id, repository_name or os.path.basename(os.path.abspath(path))],
+      )
+      for file_name, file_type, blob in zip(file_names, file_types, blobs):
+        blob_hash, size = commit_blob(*blob)
+        execute_non_query(
+            "INSERT INTO Files (repository_id, file_name, type, size, data, blob_hash) VALUES (?, ?, ?, ?, x'', ?)",
+            [repository_id, file_name, file_type, size, blob_hash],
+        )
+  finally:
+    for file in files:
+      file.close()
+
+  return repository_id
+
+  # End of import_directory()
+
+
+def run_index_jobs(file_ids, workers=4):
+  """
+  Run here the index jobs of files that no worker will pick up, `workers`
+  at a time: queued jobs and those a stopped server left running, see
+  `claim_file_job`. Jobs a live worker is running are left to it.
+  """
+
+  def task(file_id):
+    job_id = claim_file_job(file_id)
+    if job_id is not None:
+      run_index_job(job_id, file_id)
+
+  with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+    list(executor.map(in_current_run(task), file_ids))
+
+  # End of run_index_jobs()
+
+
+def to_rows(outcome):
+  """Turn a (markdown answer, cached) outcome into (conflict rows, cached)."""
+
+  if outcome is None:
+    return None
+
+  result, cached = outcome
+  return [row[1:3] + [" | ".join(row[3:])] for row in get_table_rows(result)], cached
+
+
+def run_analysis(files_dict, mode=MODE_ANALYSE, clauses=None, use_cache=True, workers=4, wait_for_jobs=True):
+  """
+  Run one kind of analysis without any UI. Files are processed `workers`
+  at a time. Without `wait_for_jobs`, pending index jobs are run here
+  first rather than waited for, as when the server that runs the workers
+  may be down. Return a list of {file_name, status, cached, conflicts}
+  where conflicts are dicts keyed by RESULT_COLUMNS[mode]; a compare run
+  yields a single entry covering all files.
+  """
+
+  if not wait_for_jobs:
+    run_index_jobs(list(files_dict), workers=workers)
+
+  if mode == MODE_COMPARE:
+    outcomes = [(", ".join(files_dict.values()), to_rows(find_cross_file_conflicts(files_dict, use_cache=use_cache)))]
+  else:
+    if mode == MODE_CHECK:
+      embeddings = embed_clauses(clauses)
+
+      def task(file_id):
+        return check_clauses(file_id, files_dict[file_id], clauses, embeddings, use_cache=use_cache)
+    else:
+      def task(file_id):
+        return to_rows(find_conflicts(file_id, use_cache=use_cache))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+      outcomes = list(zip(files_dict.values(), executor.map(in_current_run(task), files_dict)))
+
+  results = []
+  for file_name, outcome in outcomes:
+    if outcome is None:
+      results.append({"file_name": file_name, "status": "failed", "cached": False, "conflicts": []})
+      continue
+    rows, cached = outcome
+    results.append({
+        "file_name": file_name,
+        "status": "ok",
+        "cached": cached,
+        "conflicts": [dict(zip(RESULT_COLUMNS[mode], row)) for row in rows],
+    })
+
+  return results
+
+  # End of run_analysis()
@@ -4,22 +4,161 @@ import pandas as pd
 import streamlit as st
 import streamlit_antd_components as sac
 
-from helper.database import execute_non_query, fetch_all
+from helper.blob_store import commit_blob, staged_blobs
+from helper.database import execute_non_query, fetch_all, fetch_one, transaction
+from helper.file_types import sniff_files
+from helper.jobs import enqueue_index_job, show_files_status
+from helper.maintenance import request_maintenance
 
 REPOSITORY_NAME_LENGTH = 100
+REPOSITORY_PAGE_SIZE = 50
 
 
-def repository_manage(title_repository_setup):
+def fetch_repository_page(key):
+  """
+  Return one page of repositories, newest first, as rows of
+  (name, creation_date, repository_id, file_names). A paginator is shown
+  when there is more than one page.
+  """
+
+  total = fetch_one("SELECT COUNT(*) FROM Repository")[0]
+  page = 1
+  if total > REPOSITORY_PAGE_SIZE:
+    page = sac.pagination(total=total, page_size=REPOSITORY_PAGE_SIZE, align="end", jump=True, show_total=True, key=key)
+
+  return fetch_all("""
+                    SELECT name, creation_date, repository_id, file_names
+                    FROM Repository
+                    ORDER BY creation_date DESC
+                    LIMIT ? OFFSET ?""", [REPOSITORY_PAGE_SIZE, (page - 1) * REPOSITORY_PAGE_SIZE])
+
+  # End of fetch_repository_page()
+
+
+def insert_file(repository_id, file_name, file_type, blob):
+  """Add a file staged by `staged_blobs` to a repository and queue it for indexing."""
+
+  blob_hash, size = commit_blob(*blob)
+  file_id = execute_non_query(
+      "INSERT INTO Files (repository_id, file_name, type, size, data, blob_hash) VALUES (?, ?, ?, ?, x'', ?)",
+      [repository_id, file_name, file_type, size, blob_hash],
+  )
+  # Embed once, in the background, so that analysis only queries the index
+  enqueue_index_job(file_id)
+
+  return file_id
+
+
+def update_repository(repository_id, uploaded_files, remove_file_ids):
+  """
+  Add, replace and remove files of an existing repository in one
+  transaction. An uploaded file replaces the file of the same name; only
+  new or changed content is queued for indexing, and a replaced file keeps
+  its id so its index is rebuilt in place. Return the names of the files
+  added, replaced, left unchanged and removed. Raise ValueError, changing
+  nothing, if an uploaded file is not of a supported type.
+  """
+
+  file_types = sniff_files(uploaded_files)
+
+  summary = {"added": [], "replaced": [], "unchanged": [], "removed": []}
+  # Copy and hash the uploads before taking the write lock other writers wait on
+  with staged_blobs(uploaded_files) as blobs, transaction():
+    existing = {}
+    for file_id, file_name, blob_hash in fetch_all(
+        "SELECT file_id, file_name, blob_hash FROM Files WHERE repository_id = ? ORDER BY file_id ASC",
+        [repository_id],
+    ):
+      if file_id not in remove_file_ids:
+        existing.setdefault(file_name, (file_id, blob_hash))
+
+    for uploaded_file, file_type, blob in zip(uploaded_files, file_types, blobs):
+      if uploaded_file.name not in existing:
+        insert_file(repository_id, uploaded_file.name, file_type, blob)
+        summary["added"].append(uploaded_file.name)
+        continue
+
+      # Unchanged content hashes to the blob the file already refers to
+      file_id, blob_hash = existing[uploaded_file.name]
+      if blob[0] == blob_hash:
+        summary["unchanged"].append(uploaded_file.name)
+        continue
+
+      # The blob refcount triggers move the reference to the new content
+      new_blob_hash, size = commit_blob(*blob)
+      execute_non_query(
+          "UPDATE Files SET type = ?, size = ?, blob_hash = ? WHERE file_id = ?",
+          [file_type, size, new_blob_hash, file_id],
+      )
+      enqueue_index_job(file_id)
+      summary["replaced"].append(uploaded_file.name)
+
+    for file_id in remove_file_ids:
+      data = fetch_one("SELECT file_name FROM Files WHERE file_id = ? AND repository_id = ?", [file_id, repository_id])
+      if data:
+        execute_non_query("DELETE FROM Files WHERE file_id = ?", [file_id])
+        summary["removed"].append(data[0])
+
+    execute_non_query(
+        "UPDATE Repository SET modification_date = DATETIME(CURRENT_TIMESTAMP, '+8 hours') WHERE repository_id = ?",
+        [repository_id],
+    )
+
+  if summary["removed"] or summary["replaced"]:
+    # Indexes of removed files and content no longer referenced are reclaimed in the background
+    request_maintenance()
+
+  return summary
+
+  # End of update_repository()
+
+
+def delete_repositories(repository_ids):
+  """
+  Delete repositories in one transaction. Files and their Jobs go with them
+  through ON DELETE CASCADE; their indexes, stored content and free
+  database pages are reclaimed in the background.
+  """
+
+  with transaction():
+    for repository_id in repository_ids:
+      execute_non_query("DELETE FROM Repository WHERE repository_id = ?", [repository_id])
+
+  request_maintenance()
+
+
+def repository_manage(title_repository_setup, max_files):
   st.subheader("Choose one or more repositories from below to manage.")
 
   def show_repository_detail(repository_ids, names):
+    def handle_update_form(repository_id):
+      uploaded_files = st.session_state.get("key_update_files") or []
+      remove_file_ids = [int(item.split(":")[0]) for item in st.session_state.get("key_remove_files") or []]
+      if not uploaded_files and not remove_file_ids:
+        return
+
+      # An upload named like a file that stays replaces it rather than adding one
+      data = fetch_all("SELECT file_id, file_name FROM Files WHERE repository_id = ?", [repository_id])
+      remaining = [file_name for file_id, file_name in data if file_id not in remove_file_ids]
+      added = [uploaded_file for uploaded_file in uploaded_files if uploaded_file.name not in remaining]
+      if len(remaining) + len(added) > int(max_files):
+        st.session_state["update_repository_error"] = f"A repository holds up to {int(max_files)} files."
+        return
+
+      try:
+        st.session_state["update_repository_summary"] = update_repository(repository_id, uploaded_files, remove_file_ids)
+      except ValueError as e:
+        st.session_state["update_repository_error"] = str(e)
+        return
+      st.session_state["update_repository_id"] = repository_id
+      # End of handle_update_form()
+
     def handle_delete_form():
       if "key_selected_repositories" in st.session_state and "key_confirm_delete" in st.session_state:
         if st.session_state.key_selected_repositories and st.session_state.key_confirm_delete:
-          for item in st.session_state.key_selected_repositories:
-            repository_id_to_delete = item.split("[")[1][:-1].strip()
-            execute_non_query("DELETE FROM Files WHERE repository_id = ?", [repository_id_to_delete])
-            execute_non_query("DELETE FROM Repository WHERE repository_id = ?", [repository_id_to_delete])
+          delete_repositories([
+              item.split("[")[1][:-1].strip() for item in st.session_state.key_selected_repositories
+          ])
       # End of handle_delete_form()
 
     if "show_repository_option_placeholder" not in st.session_state:
@@ -37,6 +176,20 @@ def repository_manage(title_repository_setup):
         if is_selected:
           repository_selected.append(f"{lst_names[row_id]} [ {lst_repository_ids[row_id]} ]")
 
+      if len(repository_selected) == 1:
+        repository_id = repository_selected[0].split("[")[1][:-1].strip()
+        files = fetch_all("SELECT file_id, file_name FROM Files WHERE repository_id = ? ORDER BY file_name ASC",
+                          [repository_id])
+        with st.form("update_form", clear_on_submit=True):
+          st.subheader("Update Repository")
+          st.file_uploader("Add files, or replace the files of the same name (.docx, .pdf, .txt):",
+                           type=["docx", "pdf", "txt"], accept_multiple_files=True, key="key_update_files")
+          st.multiselect("Select files to remove:", options=[f"{row[0]}: {row[1]}" for row in files],
+                         key="key_remove_files")
+
+          st.form_submit_button("Update", help="Only new or changed files are indexed again",
+                                on_click=handle_update_form, args=[repository_id])
+
       if repository_selected:
         with st.form("delete_form"):
           st.subheader("Delete Repository")
@@ -50,10 +203,7 @@ def repository_manage(title_repository_setup):
 
     # End of show_repository_detail()
 
-  data = fetch_all("""
-                    SELECT t1.name, t1.creation_date, t1.repository_id, (SELECT group_concat(t2.file_name, ', ') FROM Files t2 WHERE t2.repository_id = t1.repository_id)
-                    FROM Repository t1
-                    ORDER BY t1.creation_date DESC""")
+  data = fetch_repository_page("key_repository_manage_page")
   if data:
     df = pd.DataFrame(data).set_axis(["name", "creation_date", "repository_id", "file_name"], axis="columns")
     df["select"] = False
@@ -83,6 +233,20 @@ def repository_manage(title_repository_setup):
     placeholder = st.empty()
     st.session_state['show_repository_option_placeholder'] = placeholder
 
+  if "update_repository_error" in st.session_state:
+    sac.alert(label="Oops", description=st.session_state.pop("update_repository_error"), color="error", banner=False,
+              icon=True, closable=True)
+
+  if "update_repository_summary" in st.session_state:
+    # Show Success acknowledgement screen
+    summary = st.session_state.pop("update_repository_summary")
+    sac.result(
+      label="Update Repository",
+      description=", ".join(f"{len(names)} {action}" for action, names in summary.items()),
+      status="success",
+    )
+    show_files_status(st.session_state["update_repository_id"])
+
   # End of repository_manage()
 
 
@@ -92,18 +256,20 @@ def save_repository_to_db(unique_id, uploaded_files, repository_name):
     sac.alert(label="Oops", description="Something went wrong", color="error", banner=False, icon=True, closable=True)
     return False
 
-  # Repository - Save to database
-  execute_non_query("INSERT INTO Repository (repository_id, name) VALUES (?, ?)", [unique_id, repository_name])
-  # Files - Save to database
-  for uploaded_file in uploaded_files:
-    file_name = uploaded_file.name
-    type = uploaded_file.type
-    size = uploaded_file.size
-    file_content = uploaded_file.read()
-    st.write((file_name, type, size, len(file_content)))
-    execute_non_query(
-      "INSERT INTO Files (repository_id, file_name, type, size, data) \
-      VALUES (?, ?, ?, ?, ?)", [unique_id, file_name, type, size, file_content])
+  # Check every file by its content before storing any
+  try:
+    file_types = sniff_files(uploaded_files)
+  except ValueError as e:
+    sac.alert(label="Oops", description=str(e), color="error", banner=False, icon=True, closable=True)
+    return False
+
+  # Files - Streamed into the blob store and hashed before taking the write
+  # lock, then committed together with the repository or not at all
+  with staged_blobs(uploaded_files) as blobs, transaction():
+    # Repository - Save to database
+    execute_non_query("INSERT INTO Repository (repository_id, name) VALUES (?, ?)", [unique_id, repository_name])
+    for uploaded_file, file_type, blob in zip(uploaded_files, file_types, blobs):
+      insert_file(unique_id, uploaded_file.name, file_type, blob)
 
   return True
 
@@ -141,10 +307,13 @@ def repository_uploader(max_files):
         if save_repository_to_db(unique_id=unique_id, uploaded_files=uploaded_files, repository_name=repository_name):
           placeholder.empty()
           st.session_state["save_repository_to_db"] = True
+          st.session_state["save_repository_to_db_id"] = unique_id
 
   if st.session_state.get("save_repository_to_db", False):
     # Show Success acknowledgement screen
-    sac.result(label="Set Up New Repository", description=f"unique id: {unique_id}", status="success")
+    sac.result(label="Set Up New Repository", description=f"unique id: {st.session_state['save_repository_to_db_id']}",
+               status="success")
+    show_files_status(st.session_state["save_repository_to_db_id"])
     del st.session_state["save_repository_to_db"]
 
   # End of repository_uploader()
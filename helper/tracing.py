@@ -0,0 +1,109 @@
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+
+from helper.utility import get_secret_value
+
+METRICS_RETENTION_IN_DAYS = float(get_secret_value("METRICS_RETENTION_IN_DAYS") or 30)
+
+# Run the current code belongs to; spans outside a run are not recorded
+current_run = ContextVar("current_run", default=None)
+
+# Finished spans waiting to be written, shared by all threads
+pending_spans = []
+pending_spans_lock = threading.Lock()
+
+
+@contextmanager
+def start_run(name, repository_id=None):
+  """
+  Trace one user action, e.g. an Analyse click. Spans opened inside it,
+  also from threads started with `in_current_run`, are written to the
+  Metrics table when the run ends.
+  """
+
+  if current_run.get() is not None:
+    # Already inside a run; its spans belong to the outer one
+    yield
+    return
+
+  run = {"run_id": str(uuid.uuid4()), "name": name, "repository_id": repository_id}
+  token = current_run.set(run)
+  try:
+    with span("run"):
+      yield
+  finally:
+    current_run.reset(token)
+    flush_spans()
+
+  # End of start_run()
+
+
+@contextmanager
+def span(stage):
+  """
+  Time a stage of the current run. The yielded dict takes extra fields,
+  e.g. prompt_tokens and completion_tokens of an LLM call, or cache_hits
+  and cache_misses of an embedding call.
+  """
+
+  run = current_run.get()
+  fields = {}
+  if run is None:
+    yield fields
+    return
+
+  start = time.perf_counter()
+  try:
+    yield fields
+  finally:
+    duration = time.perf_counter() - start
+    with pending_spans_lock:
+      pending_spans.append((
+          run["run_id"], run["name"], run["repository_id"], stage, duration,
+          fields.get("prompt_tokens"), fields.get("completion_tokens"),
+          fields.get("cache_hits"), fields.get("cache_misses"), time.time(),
+      ))
+
+  # End of span()
+
+
+def in_current_run(fn):
+  """Wrap `fn` so that it traces into the caller's run from any thread."""
+
+  context = copy_context()
+
+  def run_in_context(*args, **kwargs):
+    return context.copy().run(fn, *args, **kwargs)
+
+  return run_in_context
+
+
+def flush_spans():
+  """
+  Write the finished spans of every thread in one transaction, dropping
+  metrics older than METRICS_RETENTION_IN_DAYS.
+  """
+
+  with pending_spans_lock:
+    spans = pending_spans[:]
+    pending_spans.clear()
+  if not spans:
+    return
+
+  # Imported here as helper.database traces its own queries
+  from helper.database import transaction
+
+  with transaction() as conn:
+    conn.cursor().executemany(
+        """
+        INSERT INTO Metrics (run_id, run_name, repository_id, stage, duration, prompt_tokens, completion_tokens,
+                             cache_hits, cache_misses, creation_time)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        spans,
+    )
+    conn.execute("DELETE FROM Metrics WHERE creation_time < ?", [time.time() - METRICS_RETENTION_IN_DAYS * 86400])
+
+  # End of flush_spans()
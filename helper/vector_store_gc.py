@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import time
+
+from helper.database import execute_non_query, fetch_all
+from helper.jobs import JOB_QUEUED, JOB_RUNNING
+from helper.utility import get_secret_value
+
+VECTOR_STORE_MAX_MB = float(get_secret_value("VECTOR_STORE_MAX_MB") or 2048)
+# Indexes used more recently than this are never evicted, as they may be in use
+EVICTION_GRACE_IN_SECONDS = 600
+
+
+def get_vector_store_size(directory):
+  """
+  Return the bytes held by the vector store. Free pages of its SQLite file
+  are left out, as deleted collections leave them for reuse.
+  """
+
+  total = 0
+  for root, _, file_names in os.walk(directory):
+    for file_name in file_names:
+      path = os.path.join(root, file_name)
+      if file_name != "chroma.sqlite3":
+        total += os.path.getsize(path)
+        continue
+
+      conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+      try:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        live_pages = conn.execute("PRAGMA page_count").fetchone()[0] - conn.execute("PRAGMA freelist_count").fetchone()[0]
+      finally:
+        conn.close()
+      total += page_size * live_pages
+
+  return total
+
+  # End of get_vector_store_size()
+
+
+def collect_vector_store_garbage():
+  """
+  Drop the indexes of files that no longer exist. Then, while the vector
+  store is over VECTOR_STORE_MAX_MB, drop the least recently used indexes
+  of idle files; they are rebuilt on their next use. Return the ids of the
+  files whose index was dropped.
+  """
+
+  # Imported here so that starting the collector does not load the vector store
+  from helper.index import COLLECTION_PREFIX, VECTOR_STORE_DIRECTORY, delete_file_index, get_chroma_client
+
+  collections = [getattr(collection, "name", collection) for collection in get_chroma_client().list_collections()]
+  indexed = {int(name[len(COLLECTION_PREFIX):]) for name in collections if name.startswith(COLLECTION_PREFIX)}
+  existing = {row[0] for row in fetch_all("SELECT file_id FROM Files")}
+
+  dropped = sorted(indexed - existing)
+  for file_id in dropped:
+    delete_file_index(file_id)
+
+  quota = VECTOR_STORE_MAX_MB * 2**20
+  if get_vector_store_size(VECTOR_STORE_DIRECTORY) <= quota:
+    return dropped
+
+  # Indexes never recorded as used go first, then the least recently used
+  data = fetch_all(
+      """
+      SELECT t1.file_id
+      FROM Files t1
+      LEFT JOIN FileIndexes t2 ON t2.file_id = t1.file_id
+      WHERE COALESCE(t2.last_used, 0) < ?
+        AND NOT EXISTS (SELECT 1 FROM Jobs WHERE file_id = t1.file_id AND status IN (?, ?))
+      ORDER BY COALESCE(t2.last_used, 0) ASC""",
+      [time.time() - EVICTION_GRACE_IN_SECONDS, JOB_QUEUED, JOB_RUNNING],
+  )
+  for row in data:
+    file_id = row[0]
+    if file_id not in indexed:
+      continue
+    delete_file_index(file_id)
+    execute_non_query("DELETE FROM FileIndexes WHERE file_id = ?", [file_id])
+    dropped.append(file_id)
+    if get_vector_store_size(VECTOR_STORE_DIRECTORY) <= quota:
+      break
+
+  return dropped
+
+  # End of collect_vector_store_garbage()
@@ -17,9 +17,12 @@ from time import sleep
 import streamlit as st
 import streamlit_antd_components as sac
 
-from helper.analyse import analyse_choose
 from helper.authentication import prompt_login
+from helper.blob_store import migrate_inline_blobs
 from helper.database import create_db, fetch_one
+from helper.jobs import start_ingestion_workers
+from helper.maintenance import start_maintenance
+from helper.metrics import show_metrics
 from helper.repository import repository_manage, repository_uploader
 from helper.utility import get_secret_value
 
@@ -39,8 +42,25 @@ class ConfigHandler:
       return value
 
 
+@st.cache_resource(show_spinner=False)
+def load_config():
+  """Parse config.ini once per process rather than on every rerun."""
+
+  return ConfigHandler()
+
+
+@st.cache_resource(show_spinner=False)
+def initialise():
+  """Bring the database up to date and start the workers once per process."""
+
+  create_db()
+  migrate_inline_blobs()
+  start_ingestion_workers()
+  start_maintenance()
+
+
 # Initialising config.ini
-config_handler = ConfigHandler()
+config_handler = load_config()
 APPLICATION_VERSION = config_handler.get_value("application", "APPLICATION_VERSION")
 APPLICATION_AUTHOR = config_handler.get_value("application", "APPLICATION_AUTHOR")
 TITLE_DEFAULT = config_handler.get_value("title", "TITLE_DEFAULT")
@@ -49,6 +69,7 @@ TITLE_REPOSITORY = config_handler.get_value("title", "TITLE_REPOSITORY")
 TITLE_REPOSITORY_SETUP = config_handler.get_value("title", "TITLE_REPOSITORY_SETUP")
 TITLE_REPOSITORY_MANAGE = config_handler.get_value("title", "TITLE_REPOSITORY_MANAGE")
 TITLE_ANALYSE = config_handler.get_value("title", "TITLE_ANALYSE")
+TITLE_METRICS = config_handler.get_value("title", "TITLE_METRICS")
 TITLE_ABOUT_US = config_handler.get_value("title", "TITLE_ABOUT_US")
 TITLE_METHODOLOGY = config_handler.get_value("title", "TITLE_METHODOLOGY")
 TITLE_DISCLAIMER = config_handler.get_value("title", "TITLE_DISCLAIMER")
@@ -83,7 +104,7 @@ def main():
     else:
       st.title(f"{st.session_state.menu_option}")
 
-    create_db()
+    initialise()
 
     if not st.session_state.get("logged_in", False):
       if prompt_login(APPLICATION_AUTHOR, CONTENT_DISCLAIMER):
@@ -114,6 +135,7 @@ def main():
                     ],
                 ),
                 sac.MenuItem(TITLE_ANALYSE, icon="cpu"),
+                sac.MenuItem(TITLE_METRICS, icon="speedometer2"),
                 sac.MenuItem(type="divider"),
                 sac.MenuItem(TITLE_ABOUT_US, icon="info-circle"),
                 sac.MenuItem(TITLE_METHODOLOGY, icon="lightbulb"),
@@ -154,9 +176,14 @@ def main():
       elif st.session_state.menu_option == TITLE_REPOSITORY_SETUP:
         repository_uploader(MAX_NUMBER_OF_FILES)
       elif st.session_state.menu_option == TITLE_REPOSITORY_MANAGE:
-        repository_manage(TITLE_REPOSITORY_SETUP)
+        repository_manage(TITLE_REPOSITORY_SETUP, MAX_NUMBER_OF_FILES)
       elif st.session_state.menu_option == TITLE_ANALYSE:
+        # Imported on first use; it loads the LLM and vector store libraries
+        from helper.analyse import analyse_choose
+
         analyse_choose(TITLE_REPOSITORY_SETUP, CONTENT_DISCLAIMER)
+      elif st.session_state.menu_option == TITLE_METRICS:
+        show_metrics()
       elif st.session_state.menu_option == TITLE_METHODOLOGY:
         st.write(CONTENT_METHODOLOGY)
         st.image("./images/methodology.png", caption="Methodology")